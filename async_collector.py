@@ -0,0 +1,249 @@
+"""asyncio collector that polls one or more GBFS feeds from one process.
+
+Each system (city) gets its own FeedPoller with its own log directory,
+in-memory index and scheduler. All pollers share one pooled keep-alive
+HTTP session, fetch station_status and station_information concurrently
+and use ETag/If-Modified-Since so that unchanged feeds cost a 304.
+What changed is logged on one writer thread, so that a slow flush or the
+daily rotation doesn't hold up the other systems' polls.
+
+Usage:
+    python async_collector.py [systems.json] [--metrics-port PORT] [--stats-interval SECONDS]
+
+systems.json maps a system name to the base URL of its GBFS feeds, e.g.
+    {"hubway": "https://api-core.thehubway.com/gbfs/en/"}
+The hubway system logs to data/ and last_updated.txt like hub_where.py
+does. Every other system logs to systems/<name>/. The timings and counts
+of every poll are recorded into metrics.registry, labelled by system."""
+
+import os
+import sys
+import json
+import signal
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import aiohttp
+import columnar
+import hub_where
+import scheduler
+import writer
+import metrics
+import storage
+
+SYSTEMS = {'hubway': 'https://api-core.thehubway.com/gbfs/en/'}
+
+
+def get_system_paths(name):
+    """Returns the data directory, last_updated file, column directory and
+    station_information file of a system"""
+    if name == 'hubway':
+        return ('data/', 'last_updated.txt', columnar.COLUMN_DIR, 'station_information.json')
+    system_dir = os.path.join('systems', name)
+    return (os.path.join(system_dir, 'data/'), os.path.join(system_dir, 'last_updated.txt'),
+            os.path.join(system_dir, 'columns/'), os.path.join(system_dir, 'station_information.json'))
+
+
+class FeedPoller:
+    """Polls the station_status and station_information feeds of one
+    system and logs them.
+
+    timeout is the total number of seconds allowed per request, retries is
+    how many times a failed request is retried and backoff is the delay
+    before the first retry, doubling for every retry after that."""
+
+    def __init__(self, name, base_url, timeout=10, retries=3, backoff=1,
+                 poll_scheduler=None):
+        self.name = name
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+        data_dir, last_updated_file, column_dir, self.info_file = get_system_paths(name)
+        self.index = hub_where.build_index(data_dir, last_updated_file, column_dir)
+        self.scheduler = poll_scheduler or scheduler.PollScheduler()
+        metrics.registry.watch('ticks_late', lambda: self.scheduler.late, counter=True, system=name)
+        metrics.registry.watch('ticks_missed', lambda: self.scheduler.missed, counter=True, system=name)
+        # ETag and Last-Modified of the last response, per URL
+        self.validators = {}
+        self.last_status = None
+        self.polls = 0
+        self.errors = 0
+
+    async def fetch_json(self, session, feed):
+        """Fetches one feed and returns its body, or None if it hasn't
+        changed since the last fetch. Timeouts, connection errors, 429s and
+        5xxs are retried, and the last error is raised once retries run
+        out. Any other 4xx is raised straight away, since retrying won't
+        fix it."""
+        url = self.base_url + feed + '.json'
+        headers = {}
+        etag, last_modified = self.validators.get(url, (None, None))
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                async with session.get(url, headers=headers, timeout=self.timeout) as response:
+                    if response.status == 304:
+                        return None
+                    response.raise_for_status()
+                    body = await response.read()
+                    self.validators[url] = (response.headers.get('ETag'),
+                                            response.headers.get('Last-Modified'))
+                    return body
+            except aiohttp.ClientResponseError as error:
+                if attempt == self.retries or (error.status < 500 and error.status != 429):
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def poll(self, session, log_writer, write_executor=None):
+        """Fetches both feeds concurrently and logs whatever changed.
+
+        Returns the station_status dict, or None if it hadn't changed or
+        couldn't be fetched, decoded or logged. A bad response is reported
+        and counted, and only costs this system this poll.
+
+        Logging flushes, rotates and indexes logs, which blocks, so it runs
+        on write_executor if one is given, leaving the other systems to
+        poll meanwhile. log_writer isn't thread-safe, so write_executor
+        must have a single thread, shared by every poller."""
+        self.polls += 1
+        metrics.registry.add('polls', system=self.name)
+        with metrics.registry.time('fetch', system=self.name):
+            results = await asyncio.gather(self.fetch_json(session, 'station_status'),
+                                           self.fetch_json(session, 'station_information'),
+                                           return_exceptions=True)
+        status_body, info_body = results
+        if isinstance(info_body, Exception):
+            self.errors += 1
+            metrics.registry.add('fetch_errors', system=self.name)
+            print(self.name, "station_information failed:", repr(info_body))
+        elif info_body is not None:
+            try:
+                save_station_information(info_body, self.info_file)
+            except OSError as error:
+                self.errors += 1
+                metrics.registry.add('write_errors', system=self.name)
+                print(self.name, "saving station_information failed:", repr(error))
+        if isinstance(status_body, Exception):
+            self.errors += 1
+            metrics.registry.add('fetch_errors', system=self.name)
+            print(self.name, "station_status failed:", repr(status_body))
+            return None
+        if status_body is None:
+            metrics.registry.add('not_modified_polls', system=self.name)
+            return None
+        metrics.registry.add('bytes_fetched', len(status_body), system=self.name)
+        self.last_status = None
+        try:
+            with metrics.registry.time('decode', system=self.name):
+                station_status = json.loads(status_body)
+                last_status = {'last_updated': int(station_status['last_updated']),
+                               'ttl': station_status.get('ttl', self.scheduler.interval)}
+            with metrics.registry.time('diff', system=self.name):
+                batch = hub_where.detect_changes(station_status, self.index)
+        except (ValueError, KeyError, TypeError) as error:
+            self.errors += 1
+            metrics.registry.add('decode_errors', system=self.name)
+            print(self.name, "station_status is not valid:", repr(error))
+            return None
+        self.last_status = last_status
+        metrics.registry.add('changed_stations', len(batch['stations']), system=self.name)
+        try:
+            with metrics.registry.time('write', system=self.name):
+                if write_executor is None:
+                    hub_where.write_batch(batch, self.index, log_writer)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(
+                        write_executor, hub_where.write_batch, batch, self.index, log_writer)
+        except OSError as error:
+            self.errors += 1
+            metrics.registry.add('write_errors', system=self.name)
+            print(self.name, "logging failed:", repr(error))
+            return None
+        return station_status
+
+    async def run(self, session, log_writer, write_executor=None):
+        """Polls forever, sleeping between polls as the scheduler says"""
+        while True:
+            await asyncio.sleep(self.scheduler.get_delay())
+            metrics.registry.observe('tick_lateness', max(0, self.scheduler.check_tick()),
+                                     system=self.name)
+            await self.poll(session, log_writer, write_executor)
+            self.scheduler.schedule(self.last_status)
+
+
+def save_station_information(body, file_name):
+    """Saves a station_information body"""
+    directory = os.path.dirname(file_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with storage.replace_file(file_name) as workfile:
+        workfile.write(body)
+
+
+def make_session(max_connections=100):
+    """Returns a pooled keep-alive HTTP session"""
+    connector = aiohttp.TCPConnector(limit=max_connections, keepalive_timeout=120)
+    return aiohttp.ClientSession(connector=connector)
+
+
+def make_write_executor():
+    """Returns the single thread that every poller logs through"""
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+
+
+async def collect(pollers, log_writer, max_connections=100):
+    """Runs every poller until cancelled. Logging is done on a writer
+    thread, which finishes what it was handed before this returns."""
+    write_executor = make_write_executor()
+    try:
+        async with make_session(max_connections) as session:
+            await asyncio.gather(*(poller.run(session, log_writer, write_executor)
+                                   for poller in pollers))
+    finally:
+        write_executor.shutdown(wait=True)
+
+
+def load_systems(file_name=None):
+    """Loads the systems to poll from a JSON file, or returns the default"""
+    if file_name is None:
+        return SYSTEMS
+    with open(file_name, 'r') as readfile:
+        return json.load(readfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('systems', nargs='?', help="JSON file of system name -> feed base URL")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--stats-interval', type=int, metavar='SECONDS',
+                        help="print a JSON line of stats every SECONDS seconds")
+    args = parser.parse_args()
+    systems = load_systems(args.systems)
+    print("Starting logging for", len(systems), "systems!")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    for name in systems:
+        data_dir, last_updated_file = get_system_paths(name)[:2]
+        if os.path.isdir(data_dir):
+            for file_name in writer.recover_logs(data_dir, last_updated_file):
+                print("Removed torn record from", file_name)
+    log_writer = writer.LogWriter(max_handles=256)
+    metrics.registry.watch('bytes_written', lambda: log_writer.bytes_written, counter=True)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.stats_interval:
+        metrics.print_stats(args.stats_interval)
+    pollers = [FeedPoller(name, url) for name, url in systems.items()]
+    try:
+        asyncio.run(collect(pollers, log_writer))
+    finally:
+        log_writer.close()
@@ -0,0 +1,54 @@
+"""Benchmark for async_collector.py against the local stub GBFS server.
+
+Starts bench/stub_gbfs.py in-process with hundreds of fake systems, then
+polls every system as fast as possible for a few rounds and reports the
+number of polls per second. Logs are written to a temporary directory.
+
+Usage:
+    python bench/bench_async_collector.py [number of systems] [rounds]"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import async_collector
+import stub_gbfs
+import writer
+
+
+async def run_benchmark(num_systems, rounds, num_stations=200, port=8765):
+    """Polls num_systems stub systems rounds times and returns polls/second"""
+    runner = await stub_gbfs.start_stub(num_systems, num_stations, port=port)
+    log_writer = writer.LogWriter(max_handles=1024)
+    write_executor = async_collector.make_write_executor()
+    try:
+        base_url = 'http://127.0.0.1:' + str(port) + '/'
+        pollers = [async_collector.FeedPoller('system' + str(x), base_url + 'system' + str(x) + '/')
+                   for x in range(num_systems)]
+        async with async_collector.make_session() as session:
+            start = time.perf_counter()
+            for _ in range(rounds):
+                await asyncio.gather(*(poller.poll(session, log_writer, write_executor)
+                                       for poller in pollers))
+                log_writer.flush()
+            elapsed = time.perf_counter() - start
+    finally:
+        write_executor.shutdown(wait=True)
+        log_writer.close()
+        await runner.cleanup()
+    errors = sum(poller.errors for poller in pollers)
+    return num_systems * rounds / elapsed, errors
+
+
+if __name__ == "__main__":
+    num_systems = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        polls_per_second, errors = asyncio.run(run_benchmark(num_systems, rounds))
+    print("Systems:", num_systems, "Rounds:", rounds, "Errors:", errors)
+    print("Polls per second:", round(polls_per_second, 1))
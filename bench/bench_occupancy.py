@@ -0,0 +1,70 @@
+"""Benchmark for plots/occupancy.py on the bundled week of data.
+
+Times the old way of building the occupancy matrix (np.vstack once per
+station, re-reading last_updated.txt for every station) against
+occupancy.build_occupancy_matrix() and checks that both put readings in
+the same cells.
+
+Usage (from the bench directory):
+    python bench_occupancy.py"""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plots'))
+
+import occupancy
+
+
+def legacy_occupancy_array():
+    """The occupancy matrix as plots/2occupancy_plots.py used to build it"""
+    time_interval = occupancy.get_time_interval()
+    time_interval = time_interval[1] - time_interval[0]
+    time_interval = int(time_interval/10) + 1
+    station_occupancy_array = np.full((1, time_interval), 2)
+    for station_number in range(1, 219):
+        station_occupancy_array = np.vstack((station_occupancy_array, legacy_single_station(station_number, time_interval)))
+    return station_occupancy_array
+
+
+def legacy_single_station(station_number, array_length):
+    """One row of the occupancy matrix as it used to be built"""
+    file_name = '../data/' + str(station_number) + '.txt'
+    single_station_occupancy_array = np.full((1, array_length), 2)
+    time_interval = occupancy.get_time_interval()
+    try:
+        with open(file_name, 'r') as readfile:
+            readfile.readline()
+            for next_line in readfile:
+                line = json.loads(next_line)
+                index = int(line['l_r']) - time_interval[0]
+                index = int(index/10)
+                if line['n_b_a'] + line['n_d_a'] == 0:
+                    value = 0
+                else:
+                    value = line['n_b_a'] / (line['n_b_a'] + line['n_d_a'])
+                if (index < 0):
+                    index = 0
+                single_station_occupancy_array[0][index] = value
+    except FileNotFoundError:
+        pass
+    return single_station_occupancy_array
+
+
+def time_call(function):
+    """Returns the result of function() and how many seconds it took"""
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    legacy, legacy_seconds = time_call(legacy_occupancy_array)
+    matrix, seconds = time_call(occupancy.build_occupancy_matrix)
+    same_cells = np.array_equal(legacy == 2, matrix == occupancy.NO_READING)
+    print("Legacy vstack build:", round(legacy_seconds, 3), "s,", legacy.nbytes, "bytes")
+    print("Preallocated build: ", round(seconds, 3), "s,", matrix.nbytes, "bytes")
+    print("Speedup:", round(legacy_seconds / seconds, 1), "x, same cells filled:", same_cells)
@@ -0,0 +1,68 @@
+"""Benchmark for plots/resample.py on the bundled week of data.
+
+Times the old per-cell Python loops that forward-filled and averaged the
+occupancy matrix against resample.station_means() and
+resample.hourly_means(), and checks that they agree.
+
+Usage (from the bench directory):
+    python bench_resample.py"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plots'))
+
+import occupancy
+import resample
+from bench_occupancy import time_call
+
+
+def legacy_station_averages(station_occupancy_array):
+    """Station averages as plots/2occupancy_plots.py used to compute them"""
+    average_list = []
+    for station in station_occupancy_array:
+        cumulative_total = 0
+        last_item = 0
+        for item in station:
+            if item <= 1:
+                cumulative_total += item
+                last_item = item
+            else:
+                cumulative_total += last_item
+        average_list.append(cumulative_total / len(station))
+    return average_list
+
+
+def legacy_hourly_averages(station_occupancy_array):
+    """Full hours of the hourly averages as plots/4occupancy_over_time.py
+    used to compute them, without truncating them to ints"""
+    hours = int(station_occupancy_array.shape[1] / 360)
+    averages = np.zeros((station_occupancy_array.shape[0], hours))
+    for station_num, station in enumerate(station_occupancy_array):
+        last_item = 0
+        for hour in range(hours):
+            average = 0
+            for item in station[hour*360: hour*360+360]:
+                if item <= 1:
+                    average += item
+                    last_item = item
+                else:
+                    average += last_item
+            averages[station_num][hour] = average/360
+    return averages
+
+
+if __name__ == "__main__":
+    matrix = occupancy.build_occupancy_matrix()
+    legacy_means, legacy_means_seconds = time_call(lambda: legacy_station_averages(matrix))
+    means, means_seconds = time_call(lambda: resample.station_means(matrix))
+    legacy_hourly, legacy_hourly_seconds = time_call(lambda: legacy_hourly_averages(matrix))
+    hourly, hourly_seconds = time_call(lambda: resample.hourly_means(matrix))
+    # the old loop sums a float32 row into a float32 total, so it drifts
+    # a little over a week's worth of bins
+    print("Station averages, legacy:", round(legacy_means_seconds, 3), "s, vectorized:",
+          round(means_seconds, 3), "s, agree:", np.allclose(legacy_means, means, atol=1e-3))
+    print("Hourly averages, legacy:", round(legacy_hourly_seconds, 3), "s, vectorized:",
+          round(hourly_seconds, 3), "s, agree:",
+          np.allclose(legacy_hourly, hourly[:, :legacy_hourly.shape[1]], atol=1e-5))
@@ -0,0 +1,199 @@
+"""Benchmark suite for the collector and the plots, on a synthetic feed.
+
+Simulates a system of --stations stations polled --snapshots times, a
+minute apart, with synthetic_gbfs.py, feeds every snapshot straight into
+hub_where.update_station_logs() in a temporary directory, and then times
+the analysis of the logs that produced:
+    collector.*.........update_station_logs() per poll, and in total
+    occupancy_matrix....occupancy.build_occupancy_matrix()
+    occupancy_parallel..the same, with the logs read by a process per core
+    station_means.......resample.station_means() over the matrix
+    hourly_means........resample.hourly_means() over the matrix
+    aggregate_cache.....building plots/aggregate_cache.npz from scratch
+    render_frames.......every hourly frame of 4occupancy_over_time.py
+    render_plots........the three figures of 2occupancy_plots.py
+The same parameters always give the same feed, so results from different
+commits can be compared. Each analysis step is run --repeat times and the
+fastest run is kept.
+
+Results are saved as results/<commit>.json in the bench directory, and
+--baseline prints how every timing compares with an earlier result file.
+
+Usage (from the bench directory):
+    python run_benchmarks.py [--stations 200] [--snapshots 1440] [--repeat 3]
+                             [--baseline results/<commit>.json] [--threshold 1.25]"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import importlib
+import subprocess
+import tempfile
+import matplotlib
+
+matplotlib.use('Agg')
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..', 'plots'))
+
+import matplotlib.pyplot as plt
+import hub_where
+import writer
+import occupancy
+import resample
+import aggregate_cache
+import station_info
+import synthetic_gbfs
+from bench_occupancy import time_call
+
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+
+
+def get_commit():
+    """Returns the short hash of the checked out commit, marked -dirty if
+    tracked files have been changed since"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        changes = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                 cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + '-dirty' if changes.strip() else commit
+
+
+def best_of(function, repeat):
+    """Returns the result of function() and the fastest of repeat runs"""
+    result, seconds = time_call(function)
+    for _ in range(repeat - 1):
+        seconds = min(seconds, time_call(function)[1])
+    return result, seconds
+
+
+def bench_collector(snapshots):
+    """Logs every snapshot with update_station_logs() in the current
+    directory and returns the timings"""
+    index = hub_where.build_index('data/', 'last_updated.txt', 'columns/', rotate=False)
+    log_writer = writer.LogWriter()
+    poll_seconds = []
+    for station_status in snapshots:
+        poll_seconds.append(time_call(lambda: hub_where.update_station_logs(
+            station_status, index, log_writer))[1])
+    close_seconds = time_call(log_writer.close)[1]
+    poll_seconds.sort()
+    return {
+        'collector.poll_mean': sum(poll_seconds) / len(poll_seconds),
+        'collector.poll_p99': poll_seconds[int(len(poll_seconds) * 0.99)],
+        'collector.total': sum(poll_seconds) + close_seconds,
+    }
+
+
+def bench_analysis(station_information, repeat):
+    """Times the analysis and plotting of the logs in ../data/ and returns
+    the timings. Must be run from a plots directory next to them."""
+    timings = {}
+    time_interval = occupancy.get_time_interval()
+    station_numbers = occupancy.get_station_numbers()
+    matrix, timings['occupancy_matrix'] = best_of(
+        lambda: occupancy.build_occupancy_matrix(station_numbers, time_interval), repeat)
+    timings['occupancy_parallel'] = best_of(
+        lambda: occupancy.build_occupancy_matrix(station_numbers, time_interval, processes=None),
+        repeat)[1]
+    means, timings['station_means'] = best_of(lambda: resample.station_means(matrix), repeat)
+    hourly, timings['hourly_means'] = best_of(lambda: resample.hourly_means(matrix), repeat)
+    timings['aggregate_cache'] = best_of(
+        lambda: aggregate_cache.update_cache(aggregate_cache.make_cache()), repeat)[1]
+    table = station_info.get_coordinate_table(station_information)
+    station_coords, found = station_info.get_station_coords(station_numbers, table)
+    occupancy_over_time = importlib.import_module('4occupancy_over_time')
+    occupancy_over_time.init_frame_worker(hourly[station_coords[0]], station_coords, time_interval)
+    timings['render_frames'] = best_of(
+        lambda: [occupancy_over_time.render_frame(index) for index in range(hourly.shape[1])],
+        repeat)[1]
+    plt.close('all')
+    occupancy_plots = importlib.import_module('2occupancy_plots')
+
+    def render_plots():
+        occupancy_plots.plot_station_locations_and_occupancy(
+            station_coords, means[station_coords[0]])
+        plt.close('all')
+
+    timings['render_plots'] = best_of(render_plots, repeat)[1]
+    return timings
+
+
+def run_benchmarks(num_stations, num_snapshots, repeat, seed=0):
+    """Runs every benchmark in a temporary directory and returns the
+    results as a dict"""
+    system = synthetic_gbfs.SyntheticSystem(num_stations, seed)
+    snapshots = [system.get_station_status(synthetic_gbfs.START + 60 * x)
+                 for x in range(num_snapshots)]
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        try:
+            for directory in ('data', 'plots', 'diagrams'):
+                os.mkdir(directory)
+            timings = bench_collector(snapshots)
+            os.chdir('plots')
+            timings.update(bench_analysis(system.get_station_information(), repeat))
+        finally:
+            os.chdir(start_dir)
+    return {
+        'commit': get_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'parameters': {'stations': num_stations, 'snapshots': num_snapshots,
+                       'repeat': repeat, 'seed': seed},
+        'timings': timings,
+    }
+
+
+def save_results(results):
+    """Saves results as results/<commit>.json and returns the file name"""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    file_name = os.path.join(RESULTS_DIR, results['commit'] + '.json')
+    with open(file_name, 'w') as workfile:
+        json.dump(results, workfile, indent=2)
+    return file_name
+
+
+def print_results(results, baseline=None, threshold=1.25):
+    """Prints every timing, and its ratio to the baseline's if given. Marks
+    timings more than threshold times slower than the baseline."""
+    for name, seconds in results['timings'].items():
+        line = name.ljust(22) + ('%.6f' % seconds).rjust(12) + ' s'
+        if baseline is not None and name in baseline['timings']:
+            ratio = seconds / baseline['timings'][name]
+            line += ('%.2fx' % ratio).rjust(9) + ' of ' + baseline['commit']
+            if ratio > threshold:
+                line += '  SLOWER'
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--stations', type=int, default=200)
+    parser.add_argument('--snapshots', type=int, default=1440)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=None,
+                        help="an earlier result file to compare the timings with")
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help="how many times slower than the baseline counts as a regression")
+    args = parser.parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as readfile:
+            baseline = json.load(readfile)
+        if baseline['parameters'] != {'stations': args.stations, 'snapshots': args.snapshots,
+                                      'repeat': args.repeat, 'seed': 0}:
+            print("Warning: the baseline was run with", baseline['parameters'])
+    results = run_benchmarks(args.stations, args.snapshots, args.repeat)
+    print_results(results, baseline, args.threshold)
+    print("Saved to", save_results(results))
@@ -0,0 +1,83 @@
+"""Local stub HTTP server that serves fake GBFS feeds for many systems.
+
+Serves /<system>/station_status.json and /<system>/station_information.json
+for systems named system0, system1, ... with ETag and Last-Modified
+headers, answering conditional requests with 304 when nothing changed.
+The station_status of a system changes every change_every requests, with
+stations filling and emptying as synthetic_gbfs.py simulates them.
+
+Usage:
+    python bench/stub_gbfs.py [number of systems] [port]"""
+
+import sys
+import json
+import time
+from email.utils import formatdate
+from aiohttp import web
+import synthetic_gbfs
+
+
+class StubFeed:
+    """The feeds of one fake system"""
+
+    def __init__(self, num_stations, change_every, seed=0):
+        self.system = synthetic_gbfs.SyntheticSystem(num_stations, seed)
+        self.change_every = change_every
+        self.requests = 0
+        self.version = 0
+        self.info_body = json.dumps(self.system.get_station_information()).encode()
+        self.info_modified = formatdate(usegmt=True)
+        self.refresh()
+
+    def refresh(self):
+        """Makes a new station_status snapshot"""
+        self.version += 1
+        last_updated = int(time.time()) + self.version
+        self.status_body = json.dumps(self.system.get_station_status(last_updated)).encode()
+
+    def get_status(self):
+        """Returns the current station_status body and its ETag"""
+        self.requests += 1
+        if self.requests % self.change_every == 0:
+            self.refresh()
+        return self.status_body, '"' + str(self.version) + '"'
+
+
+def make_app(num_systems, num_stations=200, change_every=1):
+    """Returns the aiohttp app serving num_systems fake systems"""
+    feeds = {'system' + str(x): StubFeed(num_stations, change_every, x) for x in range(num_systems)}
+
+    async def station_status(request):
+        feed = feeds[request.match_info['system']]
+        body, etag = feed.get_status()
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type='application/json', headers={'ETag': etag})
+
+    async def station_information(request):
+        feed = feeds[request.match_info['system']]
+        if request.headers.get('If-Modified-Since') == feed.info_modified:
+            return web.Response(status=304)
+        return web.Response(body=feed.info_body, content_type='application/json',
+                            headers={'Last-Modified': feed.info_modified})
+
+    app = web.Application()
+    app.router.add_get('/{system}/station_status.json', station_status)
+    app.router.add_get('/{system}/station_information.json', station_information)
+    app['feeds'] = feeds
+    return app
+
+
+async def start_stub(num_systems, num_stations=200, change_every=1, port=8765):
+    """Starts the stub server in the running event loop and returns its
+    runner, which should be cleaned up with `await runner.cleanup()`"""
+    runner = web.AppRunner(make_app(num_systems, num_stations, change_every), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    num_systems = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8765
+    web.run_app(make_app(num_systems), host='127.0.0.1', port=port)
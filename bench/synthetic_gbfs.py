@@ -0,0 +1,178 @@
+"""Synthetic GBFS feeds with realistic churn, for the benchmarks.
+
+SyntheticSystem simulates a bike-share system one snapshot at a time.
+Every station has a capacity, a level of traffic drawn from a long-tailed
+distribution (a few busy stations, many quiet ones) and a commuting
+pattern: downtown stations fill up in the morning rush and empty in the
+evening one, residential stations do the opposite. Between two snapshots
+every station sees a Poisson number of checkouts and returns, more of
+them at rush hour than at night. Stations report when something changed
+and otherwise only now and then, the way real stations heartbeat, and
+now and then a bike breaks down or a station goes offline for service.
+
+The same seed always gives the same snapshots, so benchmark runs on
+different commits see the same data.
+
+Usage (from the bench directory):
+    python synthetic_gbfs.py [stations] [snapshots]
+prints how many station records the collector would log for that feed,
+and how many reports it would skip as heartbeats."""
+
+import sys
+import math
+import random
+
+# 2016-10-03 00:00 UTC, the start of the bundled week of data
+START = 1475452800
+CAPACITIES = (11, 15, 15, 19, 19, 23, 27, 31)
+
+
+def poisson(rng, mean):
+    """Draws from a Poisson distribution with a small mean"""
+    limit = math.exp(-mean)
+    count = 0
+    product = rng.random()
+    while product > limit:
+        count += 1
+        product *= rng.random()
+    return count
+
+
+def get_rush(t):
+    """Returns how much of the day's commuting is happening at time t: 1 at
+    the morning peak, -1 at the evening peak and about 0 at night"""
+    hour = t % 86400 / 3600
+    return math.exp(-((hour - 8) / 1.5) ** 2) - math.exp(-((hour - 17.5) / 2) ** 2)
+
+
+def get_activity(t):
+    """Returns how busy the system is at time t, relative to its busiest"""
+    hour = t % 86400 / 3600
+    return 0.15 + math.exp(-((hour - 8) / 1.5) ** 2) + math.exp(-((hour - 17.5) / 2) ** 2)
+
+
+class SyntheticSystem:
+    """A fake system of num_stations stations.
+
+    trips_per_hour is the median number of checkouts plus returns at a
+    station at rush hour, and report_probability is the chance that a
+    station with nothing new reports anyway in a snapshot."""
+
+    def __init__(self, num_stations, seed=0, trips_per_hour=6, report_probability=0.02):
+        self.rng = random.Random(seed)
+        self.report_probability = report_probability
+        self.time = None
+        self.stations = []
+        for station_number in range(1, num_stations + 1):
+            capacity = self.rng.choice(CAPACITIES)
+            bikes = self.rng.randint(capacity // 4, capacity * 3 // 4)
+            self.stations.append({
+                'station_id': str(station_number),
+                'capacity': capacity,
+                'traffic': trips_per_hour * self.rng.lognormvariate(0, 0.8),
+                'downtown': self.rng.choice((1, -1)),
+                'lat': 42.25 + self.rng.random() * 0.2,
+                'lon': -71.20 + self.rng.random() * 0.25,
+                'bikes': bikes,
+                'disabled': 0,
+                'offline_until': 0,
+                'last_reported': 0,
+            })
+
+    def get_station_information(self):
+        """Returns the station_information dict of the system"""
+        stations = [{'station_id': station['station_id'],
+                     'name': 'Station ' + station['station_id'],
+                     'lat': station['lat'],
+                     'lon': station['lon'],
+                     'capacity': station['capacity']} for station in self.stations]
+        return {'last_updated': self.time or START, 'ttl': 60, 'data': {'stations': stations}}
+
+    def advance(self, station, t, seconds):
+        """Simulates one station for the seconds up to t. Returns True if
+        anything about it changed."""
+        rng = self.rng
+        changed = False
+        if station['offline_until'] > t:
+            return False
+        if station['offline_until']:
+            station['offline_until'] = 0
+            changed = True
+        elif rng.random() < seconds / 86400 / 20:
+            # out of service for maintenance for up to two hours
+            station['offline_until'] = t + rng.randint(600, 7200)
+            return True
+        if station['disabled'] and rng.random() < seconds / 86400:
+            station['disabled'] -= 1
+            station['bikes'] += 1
+            changed = True
+        elif station['bikes'] and rng.random() < seconds / 86400 / 4:
+            station['disabled'] += 1
+            station['bikes'] -= 1
+            changed = True
+        trips = poisson(rng, station['traffic'] * get_activity(t) * seconds / 3600)
+        return_chance = 0.5 + 0.35 * station['downtown'] * get_rush(t)
+        for _ in range(trips):
+            docks = station['capacity'] - station['bikes'] - station['disabled']
+            if rng.random() < return_chance:
+                if docks:
+                    station['bikes'] += 1
+                    changed = True
+            elif station['bikes']:
+                station['bikes'] -= 1
+                changed = True
+        return changed
+
+    def get_station_status(self, t):
+        """Advances the system to time t and returns its station_status"""
+        seconds = t - self.time if self.time is not None else 0
+        self.time = t
+        stations = []
+        for station in self.stations:
+            changed = seconds > 0 and self.advance(station, t, seconds)
+            if changed or not station['last_reported'] or self.rng.random() < self.report_probability:
+                station['last_reported'] = t - self.rng.randint(0, min(max(seconds, 1), 30))
+            offline = station['offline_until'] > t
+            docks = station['capacity'] - station['bikes'] - station['disabled']
+            stations.append({'station_id': station['station_id'],
+                             'num_bikes_available': station['bikes'],
+                             'num_bikes_disabled': station['disabled'],
+                             'num_docks_available': docks,
+                             'num_docks_disabled': 0,
+                             'is_installed': 1,
+                             'is_renting': 0 if offline else 1,
+                             'is_returning': 0 if offline else 1,
+                             'last_reported': station['last_reported'],
+                             'eightd_has_available_keys': False})
+        return {'last_updated': t, 'ttl': 60, 'data': {'stations': stations}}
+
+
+def generate_snapshots(num_stations, num_snapshots, start=START, interval=60, seed=0):
+    """Yields num_snapshots station_status dicts of a synthetic system,
+    interval seconds apart"""
+    system = SyntheticSystem(num_stations, seed)
+    for snapshot in range(num_snapshots):
+        yield system.get_station_status(start + snapshot * interval)
+
+
+if __name__ == "__main__":
+    num_stations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    num_snapshots = int(sys.argv[2]) if len(sys.argv) > 2 else 1440
+    last_reported = {}
+    last_state = {}
+    records = 0
+    heartbeats = 0
+    for station_status in generate_snapshots(num_stations, num_snapshots):
+        for station in station_status['data']['stations']:
+            station_id = station['station_id']
+            if last_reported.get(station_id, -1) < station['last_reported']:
+                last_reported[station_id] = station['last_reported']
+                state = sorted((key, value) for key, value in station.items()
+                               if key != 'last_reported')
+                if last_state.get(station_id) == state:
+                    heartbeats += 1
+                else:
+                    last_state[station_id] = state
+                    records += 1
+    print("Stations:", num_stations, "Snapshots:", num_snapshots, "Records logged:", records,
+          "Heartbeats skipped:", heartbeats)
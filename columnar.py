@@ -0,0 +1,213 @@
+"""Columnar binary store for Hubway station snapshots.
+
+Every snapshot is stored as one fixed-width record spread over a set of
+append-only column files, one file per field. Each column file is a flat
+array of a single NumPy dtype, so the whole history can be memory-mapped
+and handed to the plot scripts as arrays without parsing or copying.
+
+Layout of a column directory:
+    stations.txt.........One station_id per line, line number = station index
+    s_x.col..............Station index of each record
+    l_r.col..............last_reported of each record
+    n_b_a.col, ...........Bike and dock counts of each record
+    flags.col............is_installed, is_renting, is_returning and
+                         eightd_has_available_keys packed into one byte
+    last_updated.col.....Every last_updated timestamp of the feed
+
+Use `python columnar.py` to convert the existing data/*.txt and
+last_updated.txt logs into the columns/ directory."""
+
+import os
+import sys
+import json
+import numpy as np
+import rotation
+
+COLUMN_DIR = 'columns/'
+
+COLUMNS = (
+    ('s_x', np.uint16),
+    ('l_r', np.uint32),
+    ('n_b_a', np.uint16),
+    ('n_d_a', np.uint16),
+    ('n_b_d', np.uint16),
+    ('n_d_d', np.uint16),
+    ('flags', np.uint8),
+)
+
+# bit positions of the boolean fields inside the flags column
+FLAGS = (
+    ('i_i', 1),
+    ('i_ren', 2),
+    ('i_ret', 4),
+    ('e_h_a_k', 8),
+)
+
+
+def get_column_path(column_dir, name):
+    """Returns the path of a column file"""
+    return os.path.join(column_dir, name + '.col')
+
+
+def get_station_ids(column_dir):
+    """Returns the list of station_ids, ordered by station index"""
+    try:
+        with open(os.path.join(column_dir, 'stations.txt'), 'r') as readfile:
+            return [line.strip() for line in readfile if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def get_station_indices(column_dir, station_ids):
+    """Returns a dict of station_id -> station index, registering any
+    station_ids that the column store hasn't seen before"""
+    known_ids = get_station_ids(column_dir)
+    station_indices = {station_id: index for index, station_id in enumerate(known_ids)}
+    new_ids = [x for x in station_ids if x not in station_indices]
+    if new_ids:
+        with open(os.path.join(column_dir, 'stations.txt'), 'a') as workfile:
+            for station_id in new_ids:
+                if station_id not in station_indices:
+                    station_indices[station_id] = len(station_indices)
+                    workfile.write(station_id + '\n')
+    return station_indices
+
+
+def pack_flags(station):
+    """Packs the boolean fields of a shortened station dict into one byte"""
+    flags = 0
+    for key, bit in FLAGS:
+        if station.get(key):
+            flags |= bit
+    return flags
+
+
+def make_records(stations, station_indices):
+    """Turns a list of shortened station dicts into a dict of column
+    name -> NumPy array"""
+    records = {}
+    records['s_x'] = [station_indices[station['s_i']] for station in stations]
+    records['l_r'] = [int(station['l_r']) for station in stations]
+    for key in ('n_b_a', 'n_d_a', 'n_b_d', 'n_d_d'):
+        records[key] = [station[key] or 0 for station in stations]
+    records['flags'] = [pack_flags(station) for station in stations]
+    return {name: np.array(records[name], dtype=dtype) for name, dtype in COLUMNS}
+
+
+def get_column_length(column_dir, name, dtype):
+    """Returns how many whole elements a column file holds"""
+    file_name = get_column_path(column_dir, name)
+    if not os.path.exists(file_name):
+        return 0
+    return os.path.getsize(file_name) // np.dtype(dtype).itemsize
+
+
+def get_record_count(column_dir):
+    """Returns how many whole records every column holds, which is the
+    length of the shortest column"""
+    return min(get_column_length(column_dir, name, dtype) for name, dtype in COLUMNS)
+
+
+def repair_columns(column_dir=COLUMN_DIR):
+    """Cuts every column file back to the whole records all of them hold,
+    and last_updated.col back to whole timestamps, so that a crash in the
+    middle of an append can't leave the columns out of step"""
+    count = get_record_count(column_dir)
+    lengths = [(name, dtype, count) for name, dtype in COLUMNS]
+    lengths.append(('last_updated', np.uint32,
+                    get_column_length(column_dir, 'last_updated', np.uint32)))
+    for name, dtype, length in lengths:
+        file_name = get_column_path(column_dir, name)
+        size = length * np.dtype(dtype).itemsize
+        if os.path.exists(file_name) and os.path.getsize(file_name) > size:
+            os.truncate(file_name, size)
+
+
+def append_stations(stations, column_dir=COLUMN_DIR):
+    """Appends a list of shortened station dicts to the column store"""
+    if not stations:
+        return
+    os.makedirs(column_dir, exist_ok=True)
+    station_indices = get_station_indices(column_dir, [x['s_i'] for x in stations])
+    records = make_records(stations, station_indices)
+    # a crash between two of these writes leaves some columns a record
+    # ahead, so cut them back before appending after them
+    repair_columns(column_dir)
+    for name, dtype in COLUMNS:
+        with open(get_column_path(column_dir, name), 'ab') as workfile:
+            workfile.write(records[name].tobytes())
+
+
+def append_last_updated(last_updated, column_dir=COLUMN_DIR):
+    """Appends a last_updated timestamp to the column store"""
+    os.makedirs(column_dir, exist_ok=True)
+    repair_columns(column_dir)
+    with open(get_column_path(column_dir, 'last_updated'), 'ab') as workfile:
+        workfile.write(np.array([int(last_updated)], dtype=np.uint32).tobytes())
+
+
+def map_column(column_dir, name, dtype, length=None):
+    """Memory-maps the first length elements of a column file read-only,
+    by default every whole one, or returns an empty array"""
+    if length is None:
+        length = get_column_length(column_dir, name, dtype)
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(get_column_path(column_dir, name), dtype=dtype, mode='r', shape=(length,))
+
+
+def load_columns(column_dir=COLUMN_DIR):
+    """Memory-maps every column and returns a dict of name -> array.
+
+    The arrays are views on the files, so nothing is read until it is
+    used. The boolean fields are exposed as their own arrays unpacked
+    from the flags column. Only the records every column holds in whole
+    are mapped; the files themselves are left for repair_columns(), since
+    the collector may be appending to them."""
+    length = get_record_count(column_dir)
+    columns = {name: map_column(column_dir, name, dtype, length) for name, dtype in COLUMNS}
+    for key, bit in FLAGS:
+        columns[key] = (columns['flags'] & bit) != 0
+    columns['station_ids'] = get_station_ids(column_dir)
+    columns['last_updated'] = map_column(column_dir, 'last_updated', np.uint32)
+    return columns
+
+
+def get_station_records(columns, station_id):
+    """Returns a dict of column name -> array holding only the records of
+    one station, in the order they were logged"""
+    station_index = columns['station_ids'].index(str(station_id))
+    mask = columns['s_x'] == station_index
+    return {name: columns[name][mask] for name, dtype in COLUMNS}
+
+
+def read_station_log(file_name):
+    """Reads a data/<station_id>.txt log, including any partitions sealed by
+    rotation, and returns its shortened dicts"""
+    return [json.loads(line) for line in rotation.iter_lines(file_name)]
+
+
+def convert_logs(data_dir='data/', last_updated_file='last_updated.txt',
+                 column_dir=COLUMN_DIR):
+    """Converts the JSON-lines logs into a new column store.
+
+    Records of all stations are merged and sorted by last_reported so that
+    the column store looks as if it had been written by the collector."""
+    if os.path.exists(get_column_path(column_dir, 's_x')):
+        raise FileExistsError(column_dir + ' already holds a column store')
+    station_files = [x for x in os.listdir(data_dir) if x[:-4].isdigit() and x.endswith('.txt')]
+    station_files.sort(key=lambda x: int(x[:-4]))
+    stations = []
+    for file_name in station_files:
+        stations.extend(read_station_log(os.path.join(data_dir, file_name)))
+    stations.sort(key=lambda x: int(x['l_r']))
+    append_stations(stations, column_dir)
+    timestamps = [int(line) for line in rotation.iter_lines(last_updated_file)]
+    with open(get_column_path(column_dir, 'last_updated'), 'ab') as workfile:
+        workfile.write(np.array(timestamps, dtype=np.uint32).tobytes())
+    return len(stations)
+
+
+if __name__ == "__main__":
+    column_dir = sys.argv[1] if len(sys.argv) > 1 else COLUMN_DIR
+    print("Converted", convert_logs(column_dir=column_dir), "records to", column_dir)
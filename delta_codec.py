@@ -0,0 +1,193 @@
+"""Compact change-only encoding of the station logs.
+
+In this encoding every station's log is data/<station_id>.dlt. Each
+record stores:
+    the time since the station's previous record as a varint
+    a varint bitmask of the fields that changed since the previous record
+    the new value of each changed field as a varint, in FIELDS order
+The first record of a log stores its last_reported time in full and has
+every field marked as changed. Values are zigzag encoded so that a
+negative number doesn't take up ten bytes.
+
+Usage:
+    python delta_codec.py [data directory]
+encodes every data/<station_id>.txt into a data/<station_id>.dlt next to
+it and reports how much smaller they are."""
+
+import os
+import sys
+import json
+import rotation
+
+# the fields a record can change, with the type to decode them as
+FIELDS = (
+    ('n_b_a', int),
+    ('n_d_a', int),
+    ('n_b_d', int),
+    ('n_d_d', int),
+    ('i_i', int),
+    ('i_ren', int),
+    ('i_ret', int),
+    ('e_h_a_k', bool),
+)
+
+
+def encode_varint(value, output):
+    """Appends a zigzag encoded varint to the bytearray output"""
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7f:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def decode_varint(data, position):
+    """Decodes the zigzag encoded varint at data[position].
+
+    Returns the value and the position after it. Raises IndexError if data
+    ends in the middle of the varint."""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (value >> 1) ^ -(value & 1), position
+        shift += 7
+
+
+def encode_record(record, previous=None):
+    """Encodes a shortened station dict as the changes since previous, the
+    last record written to the same log"""
+    output = bytearray()
+    last_reported = int(record['l_r'])
+    encode_varint(last_reported - (int(previous['l_r']) if previous else 0), output)
+    mask = 0
+    values = []
+    for bit, (key, field_type) in enumerate(FIELDS):
+        value = int(record[key] or 0)
+        if previous is None or value != int(previous[key] or 0):
+            mask |= 1 << bit
+            values.append(value)
+    encode_varint(mask, output)
+    for value in values:
+        encode_varint(value, output)
+    return bytes(output)
+
+
+def decode_record(data, position, previous, station_id):
+    """Decodes the record at data[position], given the state it was encoded
+    against. Returns the full record and the position after it."""
+    delta, position = decode_varint(data, position)
+    mask, position = decode_varint(data, position)
+    record = {'s_i': station_id, 'l_r': (previous['l_r'] if previous else 0) + delta}
+    for bit, (key, field_type) in enumerate(FIELDS):
+        if mask & (1 << bit):
+            value, position = decode_varint(data, position)
+            record[key] = field_type(value)
+        else:
+            record[key] = previous[key]
+    return record, position
+
+
+def get_station_id(file_name):
+    """Returns the station_id of a .dlt log"""
+    return os.path.basename(file_name)[:-4]
+
+
+def iter_records(file_name, chunk_size=65536):
+    """Yields the full records of a .dlt log one at a time, reading the file
+    in chunks. A torn record at the end of the log is left out."""
+    station_id = get_station_id(file_name)
+    previous = None
+    data = b''
+    position = 0
+    with open(file_name, 'rb') as readfile:
+        while True:
+            chunk = readfile.read(chunk_size)
+            data = data[position:] + chunk
+            position = 0
+            while position < len(data):
+                try:
+                    record, end = decode_record(data, position, previous, station_id)
+                except IndexError:
+                    break
+                previous = record
+                position = end
+                yield record
+            if not chunk:
+                return
+
+
+def get_complete_length(file_name):
+    """Returns how many bytes of a .dlt log hold complete records, and the
+    last complete record"""
+    station_id = get_station_id(file_name)
+    with open(file_name, 'rb') as readfile:
+        data = readfile.read()
+    previous = None
+    position = 0
+    while position < len(data):
+        try:
+            record, position_after = decode_record(data, position, previous, station_id)
+        except IndexError:
+            break
+        previous = record
+        position = position_after
+    return position, previous
+
+
+def recover_file(file_name):
+    """Truncates a torn trailing record left behind by a crash.
+
+    Returns True if the file had to be truncated."""
+    length, last_record = get_complete_length(file_name)
+    if length == os.path.getsize(file_name):
+        return False
+    with open(file_name, 'rb+') as workfile:
+        workfile.truncate(length)
+    return True
+
+
+def get_last_record(file_name):
+    """Returns the last complete record of a .dlt log, or None"""
+    return get_complete_length(file_name)[1]
+
+
+def encode_log(text_file, delta_file):
+    """Encodes a JSON-lines station log, including any partitions sealed by
+    rotation, into a .dlt log"""
+    output = bytearray()
+    previous = None
+    for line in rotation.iter_lines(text_file):
+        record = json.loads(line)
+        output += encode_record(record, previous)
+        previous = record
+    with open(delta_file, 'wb') as workfile:
+        workfile.write(output)
+
+
+def decode_log(delta_file):
+    """Returns a .dlt log as JSON lines, laid out like the text logs"""
+    return ''.join('\n' + json.dumps(record) for record in iter_records(delta_file))
+
+
+def encode_logs(data_dir='data/'):
+    """Encodes every text log in data_dir. Returns the total size of the
+    text logs and of the .dlt logs."""
+    text_size = 0
+    delta_size = 0
+    for file_name in os.listdir(data_dir):
+        if file_name[:-4].isdigit() and file_name.endswith('.txt'):
+            text_file = os.path.join(data_dir, file_name)
+            delta_file = text_file[:-4] + '.dlt'
+            encode_log(text_file, delta_file)
+            text_size += os.path.getsize(text_file)
+            delta_size += os.path.getsize(delta_file)
+    return text_size, delta_size
+
+
+if __name__ == "__main__":
+    text_size, delta_size = encode_logs(sys.argv[1] if len(sys.argv) > 1 else 'data/')
+    print("Text logs:", text_size, "bytes, delta logs:", delta_size, "bytes")
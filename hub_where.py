@@ -1,58 +1,224 @@
 """Script to collect data on Hubway stations."""
 
-import time
+import os
+import sys
 import json
+import signal
+import argparse
 import requests
+import columnar
+import writer
+import query
+import delta_codec
+import rotation
+import metrics
+import profiles
 
+STATION_STATUS_URL = 'https://api-core.thehubway.com/gbfs/en/station_status.json'
+# fields left out of a station's fingerprint: its id, and last_reported,
+# which moves on every report whether or not anything happened
+UNFINGERPRINTED_FIELDS = ('s_i', 'l_r')
 
-def setup():
+
+def setup(log_writer, encoding='json', dedupe=True, heartbeats=False):
     """If last_updated.txt does not exist, create the files that will be
     used to store Hubway station data.
 
     This makes sure that the text files exist, so writing to them
-    later doesn't throw any errors."""
+    later doesn't throw any errors. If they do exist, any record torn by
+    a crash is cut off the end of them instead."""
     try:
         with open('last_updated.txt', 'r') as readfile:
             pass
     except:
-        station_status = get_station_status()
-        with open('last_updated.txt', 'a') as workfile:
-            workfile.write('\n')
-            workfile.write(str(int(station_status['last_updated'])))
-        for station in station_status['data']['stations']:
-            file_name = 'data/' + station['station_id'] + '.txt'
-            with open(file_name, 'a') as workfile:
-                workfile.write('\n')
-                station = shorten_dict(station)
-                workfile.write(json.dumps(station))
+        update_station_logs(get_station_status(),
+                            build_index(encoding=encoding, dedupe=dedupe, heartbeats=heartbeats),
+                            log_writer)
+        log_writer.flush()
+        return
+    for file_name in writer.recover_logs():
+        print("Removed torn record from", file_name)
 
 
 def get_station_status():
     """Gets the station status via Hubway's API and returns it as a dict."""
-    station_status = requests.get('https://api-core.thehubway.com/gbfs/en/station_status.json')
+    station_status = requests.get(STATION_STATUS_URL)
     station_status = station_status.json()
     return station_status
 
 
-def update_station_logs(station_status):
-    """Updates the station logs and last_updated.txt"""
-    # if the file's last updated time < the station's last updated time:
+def build_index(data_dir='data/', last_updated_file='last_updated.txt',
+                column_dir=columnar.COLUMN_DIR, encoding='json', rotate=True,
+                dedupe=True, heartbeats=False):
+    """Builds the in-memory index of when everything was last logged.
+
+    Returns a dict holding the last logged last_updated time, a dict of
+    station_id -> last seen last_reported time and a dict of station_id ->
+    the fingerprint of the last logged record. This reads the tail of
+    every log file once, so that update_station_logs doesn't have to. The
+    index also remembers where the logs live and how they are encoded, so
+    that several feeds can be logged to different directories.
+
+    With the 'delta' encoding, station logs are delta_codec .dlt files and
+    the index also holds the last record of every station, which the next
+    record is encoded against.
+
+    If rotate is True, update_station_logs seals the text logs into day
+    partitions whenever the feed moves on to a new UTC day. The .dlt logs
+    are never rotated and keep growing.
+
+    If dedupe is True, a station that reports again with nothing but a new
+    last_reported time isn't logged. If heartbeats is True as well, the
+    last_reported times of those reports go to data/<station_id>.hb, so
+    it's still known when the station was last heard from."""
+    os.makedirs(data_dir, exist_ok=True)
+    index = {'last_updated': 0, 'stations': {}, 'data_dir': data_dir,
+             'last_updated_file': last_updated_file, 'column_dir': column_dir,
+             'encoding': encoding, 'last_records': {},
+             'rotate': rotate, 'rotated_day': -1,
+             'dedupe': dedupe, 'heartbeats': heartbeats, 'fingerprints': {}}
+    if os.path.exists(last_updated_file):
+        index['last_updated'] = get_last_time(last_updated_file, 0)
+    for file_name in os.listdir(data_dir):
+        station_id = file_name[:-4]
+        if not station_id.isdigit():
+            continue
+        if encoding == 'json' and file_name.endswith('.txt'):
+            file_name = os.path.join(data_dir, file_name)
+            if os.path.getsize(file_name) > 1:
+                last_record = json.loads(get_last_line(file_name))
+                index['stations'][station_id] = int(last_record['l_r'])
+                index['fingerprints'][station_id] = get_fingerprint(last_record)
+                continue
+            # rotation left the active log empty, so the last record is the
+            # last one sealed
+            last_reported = get_last_time(file_name)
+            if last_reported is not None:
+                index['stations'][station_id] = last_reported
+                sealed = list(rotation.iter_lines(file_name, last_reported, last_reported,
+                                                  active=False))
+                if sealed:
+                    index['fingerprints'][station_id] = get_fingerprint(json.loads(sealed[-1]))
+        elif encoding == 'delta' and file_name.endswith('.dlt'):
+            last_record = delta_codec.get_last_record(os.path.join(data_dir, file_name))
+            if last_record is not None:
+                index['stations'][station_id] = last_record['l_r']
+                index['last_records'][station_id] = last_record
+                index['fingerprints'][station_id] = get_fingerprint(last_record)
+    return index
+
+
+def get_fingerprint(station):
+    """Returns the fingerprint of a shortened station dict: every field
+    that says something about the station's state, as a tuple that compares
+    equal for records that only differ in last_reported"""
+    return tuple(sorted((key, value) for key, value in station.items()
+                        if key not in UNFINGERPRINTED_FIELDS))
+
+
+def detect_changes(station_status, index):
+    """Works out what has to be logged from a station_status poll.
+
+    Returns a batch dict holding the new last_updated time, or None if it
+    hasn't moved on, the shortened dicts of the stations whose
+    last_reported time grew, and (station_id, last_reported) for every
+    heartbeat left out of them. With dedupe on in the index, a report
+    whose fingerprint matches the station's last logged record is a
+    heartbeat, and heartbeats are only listed if the index asks for them.
+    index is updated to match, as if the batch had been logged."""
+    batch = {'last_updated': None, 'stations': [], 'heartbeats': []}
+    # if the last logged updated time < the station's last updated time:
     # log the station's last updated time to file
-    if int(get_last_line('last_updated.txt')) < int(station_status['last_updated']):
-        with open('last_updated.txt', 'a') as workfile:
-            workfile.write('\n')
-            workfile.write(str(int(station_status['last_updated'])))
+    if index['last_updated'] < int(station_status['last_updated']):
+        batch['last_updated'] = int(station_status['last_updated'])
+        index['last_updated'] = batch['last_updated']
     # for every station in station_status:
-    # if the log's last_reported time < the station's last reported time:
+    # if the last logged reported time < the station's last reported time:
     # log the station's information to file
     for station in station_status['data']['stations']:
-        file_name = 'data/' + station['station_id'] + '.txt'
-        last_line = json.loads(get_last_line(file_name))
-        if last_line['l_r'] < station['last_reported']:
-            with open(file_name, 'a') as workfile:
-                workfile.write('\n')
-                station = shorten_dict(station)
-                workfile.write(json.dumps(station))
+        station_id = station['station_id']
+        last_reported = int(station['last_reported'])
+        if index['stations'].get(station_id, -1) >= last_reported:
+            continue
+        index['stations'][station_id] = last_reported
+        station = shorten_dict(station)
+        if index['dedupe']:
+            # only log the station if something besides last_reported moved
+            fingerprint = get_fingerprint(station)
+            if index['fingerprints'].get(station_id) == fingerprint:
+                if index['heartbeats']:
+                    batch['heartbeats'].append((station_id, last_reported))
+                continue
+            index['fingerprints'][station_id] = fingerprint
+        batch['stations'].append(station)
+    return batch
+
+
+def write_station_logs(batch, index, log_writer, flush=False):
+    """Writes a batch from detect_changes() to the text logs.
+
+    Records are handed to log_writer, which decides when they reach the
+    disk, unless flush is True. Seals the logs into day partitions once
+    the feed moves on to a new day, and keeps the query indexes of the
+    station logs up to date with what was written out."""
+    if batch['last_updated'] is not None:
+        log_writer.write(index['last_updated_file'], str(batch['last_updated']))
+    for station in batch['stations']:
+        station_id = station['s_i']
+        if index['encoding'] == 'delta':
+            file_name = os.path.join(index['data_dir'], station_id + '.dlt')
+            log_writer.write_bytes(file_name, delta_codec.encode_record(
+                station, index['last_records'].get(station_id)))
+            index['last_records'][station_id] = station
+        else:
+            file_name = os.path.join(index['data_dir'], station_id + '.txt')
+            log_writer.write(file_name, json.dumps(station))
+    for station_id, last_reported in batch['heartbeats']:
+        log_writer.write(os.path.join(index['data_dir'], station_id + '.hb'), str(last_reported))
+    flushed = log_writer.flush() if flush else log_writer.tick()
+    # once the feed is into a new day, seal the days before it
+    if batch['last_updated'] is not None and index['rotate']:
+        day = batch['last_updated'] // rotation.DAY
+        if day > index['rotated_day']:
+            # rotation rewrites the active logs, so no handle may stay open on them
+            flushed += log_writer.flush()
+            log_writer.close()
+            flushed += rotation.rotate(index['data_dir'], index['last_updated_file'],
+                                       day * rotation.DAY)
+            index['rotated_day'] = day
+    for file_name in set(flushed):
+        if os.path.basename(file_name)[:-4].isdigit() and file_name.endswith('.txt'):
+            query.update_index(file_name)
+
+
+def update_station_logs(station_status, index=None, log_writer=None):
+    """Updates the station logs and last_updated.txt
+
+    index is the dict returned by build_index(), and is updated to match
+    what gets logged. Only the files of stations that changed are written.
+    Records are handed to log_writer, which decides when they reach the
+    disk; without one, they are written out before returning."""
+    if index is None:
+        index = build_index()
+    batch = detect_changes(station_status, index)
+    write_batch(batch, index, log_writer)
+
+
+def write_batch(batch, index, log_writer=None):
+    """Writes a batch from detect_changes() to the text logs, and to the
+    column store if it has been created.
+
+    Without a log_writer, the records are written out before returning."""
+    if os.path.isdir(index['column_dir']):
+        if batch['last_updated'] is not None:
+            columnar.append_last_updated(batch['last_updated'], index['column_dir'])
+        columnar.append_stations(batch['stations'], index['column_dir'])
+    if log_writer is None:
+        log_writer = writer.LogWriter()
+        write_station_logs(batch, index, log_writer, flush=True)
+        log_writer.close()
+    else:
+        write_station_logs(batch, index, log_writer)
 
 
 def get_last_line(file_name):
@@ -65,6 +231,15 @@ def get_last_line(file_name):
     return last_line.decode("utf-8")
 
 
+def get_last_time(file_name, default=None):
+    """Returns the time of the last record of a log. Only the tail of the
+    active log is read, unless rotation has left it empty."""
+    if os.path.getsize(file_name) > 1:
+        return rotation.get_record_time(get_last_line(file_name))
+    bounds = rotation.get_bounds(file_name)
+    return bounds[1] if bounds else default
+
+
 def shorten_dict(station):
     """Function to shorten a station dict's keys so that it takes up less space."""
     station['s_i'] = station.pop('station_id', None)
@@ -80,9 +255,46 @@ def shorten_dict(station):
     return station
 
 if __name__ == "__main__":
+    # imported here since the pipeline is built out of this module
+    import pipeline
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--encoding', choices=['json', 'delta'], default='json',
+                        help="log stations as JSON lines, or as compact delta_codec records,"
+                             " which are never rotated")
+    parser.add_argument('--no-rotate', action='store_true',
+                        help="don't seal the text logs into compressed day partitions")
+    parser.add_argument('--keep-heartbeats', action='store_true',
+                        help="log every report, even if nothing but last_reported changed")
+    parser.add_argument('--heartbeat-index', action='store_true',
+                        help="record the times of reports that weren't logged in data/<station_id>.hb")
+    parser.add_argument('--sqlite', metavar='DATABASE',
+                        help="also insert every logged record into this SQLite database")
+    parser.add_argument('--watch', metavar='STATIONS',
+                        help="comma-separated station_ids to report when they stray from their "
+                             "occupancy profile")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--stats-interval', type=int, metavar='SECONDS',
+                        help="print a JSON line of stats every SECONDS seconds")
+    args = parser.parse_args()
     print("Starting logging!")
-    setup()
-    while True:
-        if time.time() % 60 == 0:
-            print(int(time.time()))
-            update_station_logs(get_station_status())
+    # make sure a kill flushes the buffered records like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log_writer = writer.LogWriter()
+    setup(log_writer, args.encoding, not args.keep_heartbeats, args.heartbeat_index)
+    index = build_index(encoding=args.encoding, rotate=not args.no_rotate,
+                        dedupe=not args.keep_heartbeats, heartbeats=args.heartbeat_index)
+    sinks = [pipeline.TextLogSink(index, log_writer)]
+    # if the column store has been created, keep it in sync as well
+    if os.path.isdir(index['column_dir']):
+        sinks.append(pipeline.ColumnarSink(index['column_dir']))
+    if args.sqlite:
+        sinks.append(pipeline.SQLiteSink(args.sqlite))
+    # likewise the occupancy profiles, which --watch needs
+    if os.path.exists(profiles.PROFILE_FILE) or args.watch:
+        sinks.append(pipeline.ProfileSink(index, watch=args.watch.split(',') if args.watch else ()))
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.stats_interval:
+        metrics.print_stats(args.stats_interval)
+    pipeline.run_collector(index, sinks)
@@ -0,0 +1,185 @@
+"""Instrumentation of the collector loop.
+
+The collectors record what every poll costs into metrics.registry: how
+long the HTTP fetch, the JSON decode, the change detection and the writes
+took, how many stations changed, how many bytes were written, and how
+many ticks came late or were missed. Metrics can have labels, such as the
+system a poll was for or the sink a write went to.
+
+serve() exposes the registry on localhost in the Prometheus text format:
+    hub_where_<name>_total..................a counter
+    hub_where_<name>_seconds_sum/_count.....a timing, as a summary
+    hub_where_<name>_seconds_max............the longest of a timing
+    hub_where_<name>........................a gauge
+and print_stats() prints a JSON line every so often with what happened
+since the last one."""
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'hub_where_'
+
+
+def format_key(name, labels):
+    """Returns a metric name with its labels, Prometheus style"""
+    if not labels:
+        return name
+    return name + '{' + ','.join(key + '="' + str(value) + '"' for key, value in labels) + '}'
+
+
+class Metrics:
+    """Counters, timings and gauges, safe to update from several threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+
+    def add(self, name, amount=1, **labels):
+        """Adds amount to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        """Records one timing"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total, longest = self.timings.get(key, (0, 0.0, 0.0))
+            self.timings[key] = (count + 1, total + seconds, max(longest, seconds))
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Times the body of a with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def watch(self, name, function, counter=False, **labels):
+        """Reads a value from function() whenever the metrics are rendered.
+        counter says whether the value only ever goes up."""
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = (function, counter)
+
+    def get_stats(self):
+        """Returns every metric as a dict of counters, timings and gauges.
+        Counters and gauges are keyed by name and labels, and timings by
+        (name, labels) so that suffixes can go on the name."""
+        with self.lock:
+            counters = dict(self.counters)
+            timings = dict(self.timings)
+            gauges = dict(self.gauges)
+        stats = {'counters': {}, 'timings': {}, 'gauges': {}}
+        for (name, labels), value in counters.items():
+            stats['counters'][format_key(name, labels)] = value
+        for (name, labels), (count, total, longest) in timings.items():
+            stats['timings'][(name, labels)] = {'count': count, 'sum': total, 'max': longest}
+        for (name, labels), (function, counter) in gauges.items():
+            section = 'counters' if counter else 'gauges'
+            stats[section][format_key(name, labels)] = function()
+        return stats
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        with self.lock:
+            counters = dict(self.counters)
+            timings = dict(self.timings)
+            gauges = dict(self.gauges)
+        families = {}
+        for (name, labels), value in counters.items():
+            families.setdefault((PREFIX + name + '_total', 'counter'), []).append((labels, value))
+        for (name, labels), (function, counter) in gauges.items():
+            if counter:
+                families.setdefault((PREFIX + name + '_total', 'counter'), []).append((labels, function()))
+            else:
+                families.setdefault((PREFIX + name, 'gauge'), []).append((labels, function()))
+        lines = []
+        for (name, kind), samples in sorted(families.items()):
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for labels, value in samples:
+                lines.append(format_key(name, labels) + ' ' + str(value))
+        by_name = {}
+        for (name, labels), value in timings.items():
+            by_name.setdefault(PREFIX + name + '_seconds', []).append((labels, value))
+        for name, samples in sorted(by_name.items()):
+            lines.append('# TYPE ' + name + ' summary')
+            for labels, (count, total, longest) in samples:
+                lines.append(format_key(name + '_sum', labels) + ' ' + repr(total))
+                lines.append(format_key(name + '_count', labels) + ' ' + str(count))
+            lines.append('# TYPE ' + name + '_max gauge')
+            for labels, (count, total, longest) in samples:
+                lines.append(format_key(name + '_max', labels) + ' ' + repr(longest))
+        return '\n'.join(lines) + '\n'
+
+
+# the metrics of this process
+registry = Metrics()
+
+
+def make_handler(metrics):
+    """Returns a request handler class that serves metrics at /metrics"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serves the metrics in the Prometheus text format"""
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def serve(port=9108, metrics=registry):
+    """Serves the metrics on localhost from a background thread. Returns
+    the server, which can be stopped with shutdown()."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(metrics))
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print("Serving metrics on http://127.0.0.1:" + str(port) + "/metrics")
+    return server
+
+
+def get_stats_line(stats, last_stats, interval):
+    """Returns the JSON stats line for what happened between last_stats and
+    stats: counter increases, and the number and mean of every timing"""
+    line = {'time': int(time.time()), 'interval': interval}
+    for key, value in stats['counters'].items():
+        line[key] = value - last_stats['counters'].get(key, 0)
+    for (name, labels), timing in stats['timings'].items():
+        last_timing = last_stats['timings'].get((name, labels), {'count': 0, 'sum': 0.0})
+        count = timing['count'] - last_timing['count']
+        line[format_key(name + '_count', labels)] = count
+        line[format_key(name + '_mean', labels)] = (
+            round((timing['sum'] - last_timing['sum']) / count, 6) if count else None)
+    line.update(stats['gauges'])
+    return json.dumps(line, sort_keys=True)
+
+
+def print_stats(interval=60, metrics=registry):
+    """Prints a JSON stats line every interval seconds from a background
+    thread"""
+
+    def run():
+        last_stats = metrics.get_stats()
+        while True:
+            time.sleep(interval)
+            stats = metrics.get_stats()
+            print(get_stats_line(stats, last_stats, interval), flush=True)
+            last_stats = stats
+
+    threading.Thread(target=run, name='stats', daemon=True).start()
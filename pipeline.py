@@ -0,0 +1,357 @@
+"""Streaming pipeline that hub_where.py runs to collect station data.
+
+Every poll flows through a chain of generators:
+    poll_feed........Sleeps until the scheduler's next tick and fetches
+    decode_feed......Parses the JSON and schedules the next poll
+    find_changes.....Keeps only what changed since the last poll
+    fan_out..........Hands each batch of changes to every sink
+A batch is the dict returned by hub_where.detect_changes(). Each sink
+consumes batches on its own thread from a bounded queue, so a slow sink
+(a database on a busy disk, say) never delays the next poll. If a sink
+falls so far behind that its queue fills up, new batches are dropped for
+that sink and counted, rather than letting memory grow without bound.
+
+Every stage records its timings and counts into metrics.registry.
+
+Sinks:
+    TextLogSink......The JSON-lines (or delta) logs in data/ and last_updated.txt
+    ColumnarSink.....The column store in columns/
+    SQLiteSink.......A local SQLite database, one transaction per drain
+    ProfileSink......The per-station occupancy profiles in profiles.npz"""
+
+import json
+import time
+import queue
+import sqlite3
+import threading
+import requests
+import columnar
+import hub_where
+import scheduler
+import metrics
+import profiles
+
+# columns of the SQLite station_status table, with the shortened keys
+# they are taken from
+SQLITE_FIELDS = (
+    ('station_id', 's_i'),
+    ('last_reported', 'l_r'),
+    ('num_bikes_available', 'n_b_a'),
+    ('num_docks_available', 'n_d_a'),
+    ('num_bikes_disabled', 'n_b_d'),
+    ('num_docks_disabled', 'n_d_d'),
+    ('is_installed', 'i_i'),
+    ('is_renting', 'i_ren'),
+    ('is_returning', 'i_ret'),
+    ('eightd_has_available_keys', 'e_h_a_k'),
+)
+
+
+def poll_feed(url, poll_scheduler, session):
+    """Yields the station_status body of every poll. A failed fetch is
+    reported and retried on the next regular tick."""
+    metrics.registry.watch('ticks_late', lambda: poll_scheduler.late, counter=True)
+    metrics.registry.watch('ticks_missed', lambda: poll_scheduler.missed, counter=True)
+    while True:
+        metrics.registry.observe('tick_lateness', max(0, poll_scheduler.wait()))
+        print(int(time.time()))
+        metrics.registry.add('polls')
+        try:
+            with metrics.registry.time('fetch'):
+                response = session.get(url, timeout=10)
+                response.raise_for_status()
+        except requests.RequestException as error:
+            print("station_status failed:", repr(error))
+            metrics.registry.add('fetch_errors')
+            poll_scheduler.schedule()
+            continue
+        metrics.registry.add('bytes_fetched', len(response.content))
+        yield response.content
+
+
+def decode_feed(bodies, poll_scheduler):
+    """Yields every body parsed as a station_status dict, and schedules the
+    poll after it"""
+    for body in bodies:
+        try:
+            with metrics.registry.time('decode'):
+                station_status = json.loads(body)
+            poll_scheduler.schedule(station_status)
+        except (ValueError, KeyError, TypeError) as error:
+            print("station_status is not valid:", repr(error))
+            metrics.registry.add('decode_errors')
+            poll_scheduler.schedule()
+            continue
+        yield station_status
+
+
+def find_changes(statuses, index, poll_scheduler):
+    """Yields a batch of what has to be logged for every station_status. A
+    station_status that isn't shaped like one (an error message served in
+    its place, say) is reported and skipped, and the next poll goes back
+    to the regular schedule."""
+    for station_status in statuses:
+        try:
+            with metrics.registry.time('diff'):
+                batch = hub_where.detect_changes(station_status, index)
+        except (KeyError, TypeError, ValueError) as error:
+            print("station_status is not valid:", repr(error))
+            metrics.registry.add('decode_errors')
+            poll_scheduler.schedule()
+            continue
+        metrics.registry.add('changed_stations', len(batch['stations']))
+        if batch['last_updated'] is None:
+            metrics.registry.add('stale_polls')
+        yield batch
+
+
+def fan_out(batches, sinks):
+    """Hands every batch to every sink without waiting for them"""
+    for batch in batches:
+        for sink in sinks:
+            sink.put(batch)
+
+
+class Sink:
+    """Consumes batches on its own thread from a bounded queue.
+
+    Subclasses implement write(), which gets every batch that queued up
+    while the last write was running, so that slow sinks write in bigger
+    chunks rather than falling further behind. A failed write is reported
+    and its batches are lost to this sink only. A sink that can't be set
+    up is marked failed and ignores batches from then on."""
+
+    def __init__(self, max_batches=1000):
+        self.batches = queue.Queue(max_batches)
+        self.dropped = 0
+        self.errors = 0
+        self.failed = False
+        self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+
+    def start(self):
+        """Starts consuming batches"""
+        metrics.registry.watch('sink_queue_depth', self.batches.qsize, sink=self.thread.name)
+        self.thread.start()
+
+    def put(self, batch):
+        """Queues a batch without blocking, dropping it if the queue is full"""
+        if self.failed:
+            return
+        try:
+            self.batches.put_nowait(batch)
+        except queue.Full:
+            self.dropped += 1
+            metrics.registry.add('sink_dropped_batches', sink=self.thread.name)
+            print(type(self).__name__, "is behind, dropped batches:", self.dropped)
+
+    def stop(self):
+        """Writes out everything that's queued and stops the thread"""
+        # a thread that died would never make room in a full queue
+        while self.thread.is_alive():
+            try:
+                self.batches.put(None, timeout=1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+
+    def run(self):
+        """Writes batches as they come in until stop() is called"""
+        try:
+            try:
+                self.open()
+            except Exception as error:
+                self.failed = True
+                metrics.registry.add('sink_errors', sink=self.thread.name)
+                print(type(self).__name__, "could not be set up:", repr(error))
+                return
+            stopping = False
+            while not stopping:
+                batches = [self.batches.get()]
+                while not self.batches.empty():
+                    batches.append(self.batches.get_nowait())
+                if None in batches:
+                    stopping = True
+                    batches = batches[:batches.index(None)]
+                if not batches:
+                    continue
+                try:
+                    with metrics.registry.time('sink_write', sink=self.thread.name):
+                        self.write(batches)
+                except Exception as error:
+                    self.errors += 1
+                    metrics.registry.add('sink_errors', sink=self.thread.name)
+                    print(type(self).__name__, "failed:", repr(error))
+        finally:
+            self.close()
+
+    def prepare(self):
+        """Does whatever has to happen before the first poll, on the
+        collector's thread"""
+
+    def open(self):
+        """Sets up the sink, on its own thread"""
+
+    def write(self, batches):
+        """Writes a list of batches"""
+        raise NotImplementedError
+
+    def close(self):
+        """Tears down the sink, on its own thread"""
+
+
+class TextLogSink(Sink):
+    """Writes batches to the station logs and last_updated.txt through a
+    LogWriter, which must not be used by anything else while this runs"""
+
+    def __init__(self, index, log_writer, max_batches=1000):
+        Sink.__init__(self, max_batches)
+        self.index = index
+        self.log_writer = log_writer
+        metrics.registry.watch('bytes_written', lambda: log_writer.bytes_written, counter=True)
+
+    def write(self, batches):
+        for batch in batches:
+            hub_where.write_station_logs(batch, self.index, self.log_writer)
+
+    def close(self):
+        self.log_writer.close()
+
+
+class ColumnarSink(Sink):
+    """Appends batches to the column store"""
+
+    def __init__(self, column_dir=columnar.COLUMN_DIR, max_batches=1000):
+        Sink.__init__(self, max_batches)
+        self.column_dir = column_dir
+
+    def write(self, batches):
+        for batch in batches:
+            if batch['last_updated'] is not None:
+                columnar.append_last_updated(batch['last_updated'], self.column_dir)
+        columnar.append_stations([station for batch in batches for station in batch['stations']],
+                                 self.column_dir)
+
+
+class SQLiteSink(Sink):
+    """Inserts batches into a SQLite database.
+
+    Every drain of the queue is one transaction with one executemany()
+    per table. Records already in the database are ignored, so replaying
+    a batch is harmless."""
+
+    def __init__(self, database='stations.db', max_batches=1000):
+        Sink.__init__(self, max_batches)
+        self.database = database
+        self.connection = None
+
+    def open(self):
+        # SQLite connections can only be used on the thread that made them
+        self.connection = sqlite3.connect(self.database)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS station_status ('
+            + ', '.join(name + (' TEXT' if key == 's_i' else ' INTEGER') for name, key in SQLITE_FIELDS)
+            + ', PRIMARY KEY (station_id, last_reported))')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS last_updated '
+                                '(last_updated INTEGER PRIMARY KEY)')
+        self.connection.commit()
+
+    def write(self, batches):
+        rows = [tuple(station[key] for name, key in SQLITE_FIELDS)
+                for batch in batches for station in batch['stations']]
+        timestamps = [(batch['last_updated'],) for batch in batches
+                      if batch['last_updated'] is not None]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO station_status VALUES ('
+                + ', '.join('?' * len(SQLITE_FIELDS)) + ')', rows)
+            self.connection.executemany('INSERT OR IGNORE INTO last_updated VALUES (?)', timestamps)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+class ProfileSink(Sink):
+    """Samples the state of every station into the occupancy profiles once
+    a minute of feed time.
+
+    Before the first poll, samples whatever was logged since the profiles
+    were last saved. That has to be done before the first batch, which
+    rotates the logs it reads. Stations in watch are checked against their profile on every
+    poll, and reported when they are empty at an hour they rarely are, or
+    have bikes at an hour they are usually empty. The profiles are saved
+    every save_interval seconds of feed time and when the sink stops."""
+
+    def __init__(self, index, file_name=profiles.PROFILE_FILE, watch=(), save_interval=600,
+                 max_batches=1000):
+        Sink.__init__(self, max_batches)
+        self.index = index
+        self.file_name = file_name
+        self.watch = [str(station_id) for station_id in watch]
+        self.save_interval = save_interval
+        self.profile = None
+        self.states = {}
+        self.alerts = {}
+        self.saved_until = -1
+
+    def prepare(self):
+        self.profile = profiles.load_profile(self.file_name)
+        self.states = profiles.update_from_logs(self.profile, self.index['data_dir'],
+                                                self.index['last_updated_file'],
+                                                self.index['encoding'])
+        self.save()
+
+    def write(self, batches):
+        for batch in batches:
+            for station in batch['stations']:
+                self.states[station['s_i']] = station
+            if batch['last_updated'] is None:
+                continue
+            profiles.sample_states(self.profile, self.states, batch['last_updated'])
+            if self.watch:
+                self.report(batch['last_updated'])
+        if self.profile['sampled_until'] - self.saved_until >= self.save_interval:
+            self.save()
+
+    def report(self, t):
+        """Prints the watched stations that have started to stray from their
+        profile"""
+        alerts = {}
+        for station_id, kind, chance in profiles.check_poll(self.profile, self.states, t,
+                                                            self.watch):
+            alerts[station_id] = kind
+            if self.alerts.get(station_id) != kind:
+                print("Station", station_id, "has", self.states[station_id]['n_b_a'],
+                      "bikes, " + kind + ": empty", str(round(chance * 100)) + "%",
+                      "of the time at this hour")
+        self.alerts = alerts
+
+    def save(self):
+        """Saves the profiles"""
+        profiles.save_profile(self.profile, self.file_name)
+        self.saved_until = int(self.profile['sampled_until'])
+
+    def close(self):
+        if self.profile is not None:
+            self.save()
+
+
+def run_collector(index, sinks, poll_scheduler=None, url=hub_where.STATION_STATUS_URL):
+    """Polls the feed forever and fans what changed out to the sinks.
+    Everything queued is written out when this is interrupted."""
+    if poll_scheduler is None:
+        poll_scheduler = scheduler.PollScheduler()
+    for sink in sinks:
+        sink.prepare()
+    for sink in sinks:
+        sink.start()
+    try:
+        with requests.Session() as session:
+            statuses = decode_feed(poll_feed(url, poll_scheduler, session), poll_scheduler)
+            fan_out(find_changes(statuses, index, poll_scheduler), sinks)
+    finally:
+        for sink in sinks:
+            sink.stop()
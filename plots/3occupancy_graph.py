@@ -1,6 +1,9 @@
 """Script to plot Hubway station occupancy data"""
 
+import numpy as np
 import matplotlib.pyplot as plt
+import occupancy
+import aggregate_cache
 
 def plot_occupancy(occupancy_data):
     """Plots station occupancy"""
@@ -16,16 +19,15 @@ def plot_occupancy(occupancy_data):
 
 
 def get_occupancy_data():
-    """Gets the occupancy data"""
+    """Gets the occupancy data from the aggregate cache, folding in anything
+    logged since the cache was last refreshed"""
     # first index is list of station numbers
     # second index is list of average occupancies
-    occupancy_data = [[], []]
-    with open('average_occupancies.txt', 'r') as readfile:
-        for line in readfile:
-            newline = line.split(':')
-            occupancy_data[0].append(int(newline[0]))
-            occupancy_data[1].append(float(newline[1]))
-    return occupancy_data
+    cache = aggregate_cache.refresh_cache()
+    until = occupancy.get_time_interval()[1]
+    station_ids, averages = aggregate_cache.get_station_averages(cache, until)
+    order = np.argsort(station_ids)
+    return [station_ids[order].tolist(), averages[order].tolist()]
 
 if __name__ == "__main__":
     occupancy_data = get_occupancy_data()
@@ -1,132 +1,29 @@
 """Script to plot Hubway station data"""
 
-import json
 import time
-import requests
-import numpy as np
+import argparse
+import subprocess
+import multiprocessing
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
-
-def get_station_info():
-    """Gets the station info and returns it as a dict."""
-    station_info = requests.get('https://api-core.thehubway.com/gbfs/en/station_information.json')
-    station_info = station_info.json()
-    return station_info
-
-
-def parse_station_coordinates(station_info):
-    """Takes the station info and returns a list of [id, lat, lon] for each
-    station"""
-    station_coords = [[], [], []]
-    for station in station_info['data']['stations']:
-        station_coords[0].append(station['station_id'])
-        station_coords[1].append(station['lat'])
-        station_coords[2].append(station['lon'])
-    if len(station_coords[0]) == len(station_coords[1]):
-        if len(station_coords[0]) == len(station_coords[2]):
-            return station_coords
-    else:
-        return None
-
-
-def get_station_occupancy_array():
-    """Gets how full the stations are over time"""
-    # we want: station number as row, timestamp at column, number of bikes as
-        # content
-    # For example, station_occupancy_array[station_number][timestamp] = 12/15 bikes
-    # I also left debugging comments in here because the array
-        # is uncomfortably large
-    time_interval = get_time_interval()
-    time_interval = time_interval[1] - time_interval[0]
-    time_interval = int(time_interval/10) + 1
-    station_occupancy_array = np.full((1, time_interval), 2)
-    # cumulative_size = 0
-    # print("Shape of master:", station_occupancy_array.shape)
-    for station_number in range(1, 219):
-        station_occupancy_array = np.vstack((station_occupancy_array, get_single_station_occupancy(station_number, time_interval)))
-        # new_station_occupancy_array = get_single_station_occupancy(station_number, time_interval)
-        # cumulative_size += new_station_occupancy_array.nbytes
-    # print("Size of final array would be this many bytes:", cumulative_size)
-    return station_occupancy_array
-
-
-def get_time_interval():
-    """Function to get the time interval where data was collected from
-    last_updated.txt"""
-    with open('../last_updated.txt', 'rb') as readfile:
-        readfile.readline()
-        first_line = readfile.readline()
-        readfile.seek(-2, 2)
-        while readfile.read(1) != b'\n':
-            readfile.seek(-2, 1)
-        last_line = readfile.readline()
-    return (int(first_line.decode("utf-8")), int(last_line.decode("utf-8")))
-
-
-def get_single_station_occupancy(station_number, array_length):
-    """Gets how full one station is over time"""
-    file_name = '../data/' + str(station_number) + '.txt'
-    single_station_occupancy_array = np.full((1, array_length), 2)
-    time_interval = get_time_interval()
-    line_counter = 1
-    try:
-        with open(file_name, 'r') as readfile:
-            readfile.readline()
-            for next_line in readfile:
-                line = json.loads(next_line)
-                index = int(line['l_r']) - time_interval[0]
-                index = int(index/10)
-                if line['n_b_a'] + line['n_d_a'] == 0:
-                    value = 0
-                else:
-                    value = line['n_b_a'] / (line['n_b_a'] + line['n_d_a'])
-                if (index < 0):
-                    index = 0
-                single_station_occupancy_array[0][index] = value
-                line_counter += 1
-    except FileNotFoundError:
-        pass
-    print("Returned data for station:", station_number, "\n")
-    return single_station_occupancy_array
+import occupancy
+import resample
+import station_info
 
 def get_station_hourly_average(station_occupancy_array):
-    """Gets the averages for all the stations and returns an array"""
-    averages_array = np.full((1, int(station_occupancy_array.shape[1]/360+1)), 0)
-    for station_num in range(1, 219):
-        averages_array = np.vstack((averages_array, get_single_station_hourly_average(station_occupancy_array, station_num)))
-    return averages_array
-
-def get_single_station_hourly_average(station_occupancy_array, station_num):
-    """Gets the average for one station and returns an array"""
-    end = int(station_occupancy_array.shape[1] / 360 + 1)
-    begin = 0
-    average_array = np.full((1, end), 0)
-    average = 0
-    last_item = 0
-    while begin < end-1:
-        temp = station_occupancy_array[station_num][begin*360: begin*360+360]
-        for item in temp:
-            if item <= 1:
-                average += item
-                last_item = item
-            else:
-                average += last_item
-        average_array[0][begin] = average/360
-        # print("Station, Hour, Average", station_num, begin, average/360)
-        begin += 1
-        average = 0
-    return average_array
+    """Gets the hourly averages for all the stations and returns an array"""
+    return resample.hourly_means(station_occupancy_array)
+
 
 def plot_stations_hourly_average(station_averages, station_coords, time_interval):
     """Creates a bunch of plots based on the hourly station average"""
-    colorline = cm.rainbow(np.linspace(0, 1, 2001))
     for index in range(station_averages.shape[1]):
         plt.figure()
         average_slice = station_averages[:, index]
-        station_colormap = [colorline[int(2000*x)] for x in average_slice]
-        average_slice = [600 * x for x in average_slice]
-        plt.scatter(station_coords[2], station_coords[1], s=average_slice, c=station_colormap)
-        plt.title(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time_interval[0]+3600*index)))
+        station_colormap = cm.rainbow(average_slice)
+        plt.scatter(station_coords[2], station_coords[1], s=600 * average_slice, c=station_colormap)
+        plt.title(get_frame_title(time_interval, index))
         plt.xlim(-71.20, -70.95)
         plt.ylim(42.25, 42.45)
         plt.savefig('../diagrams/4_'+str(index)+'.png')
@@ -134,11 +31,104 @@ def plot_stations_hourly_average(station_averages, station_coords, time_interval
         print("Generated figure:", index)
 
 
+def get_frame_title(time_interval, index):
+    """Returns the title of the frame for hour number index"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time_interval[0]+3600*index))
+
+
+# the figure each rendering process draws all of its frames on
+frame_state = {}
+
+
+def init_frame_worker(station_averages, station_coords, time_interval):
+    """Sets up the one figure and scatter artist a rendering process reuses
+    for every frame it draws"""
+    matplotlib.use('Agg')
+    figure = plt.figure()
+    scatter = plt.scatter(station_coords[2], station_coords[1])
+    plt.xlim(-71.20, -70.95)
+    plt.ylim(42.25, 42.45)
+    frame_state['figure'] = figure
+    frame_state['scatter'] = scatter
+    frame_state['title'] = plt.title('')
+    frame_state['station_averages'] = station_averages
+    frame_state['time_interval'] = time_interval
+
+
+def render_frame(index, file_name=None):
+    """Draws the frame for hour number index by updating the sizes, colors
+    and title of the worker's scatter plot. Saves it to file_name if given,
+    otherwise returns its raw RGBA pixels."""
+    average_slice = frame_state['station_averages'][:, index]
+    frame_state['scatter'].set_sizes(600 * average_slice)
+    frame_state['scatter'].set_facecolors(cm.rainbow(average_slice))
+    frame_state['title'].set_text(get_frame_title(frame_state['time_interval'], index))
+    if file_name:
+        frame_state['figure'].savefig(file_name)
+        return index
+    frame_state['figure'].canvas.draw()
+    return bytes(frame_state['figure'].canvas.buffer_rgba())
+
+
+def get_frame_size(_=None):
+    """Returns the width and height in pixels of the frames the worker
+    renders"""
+    return [int(x) for x in frame_state['figure'].canvas.get_width_height(physical=True)]
+
+
+def save_frame(index):
+    """Renders the frame for hour number index to the diagrams directory"""
+    return render_frame(index, '../diagrams/4_'+str(index)+'.png')
+
+
+def plot_stations_hourly_average_parallel(station_averages, station_coords, time_interval,
+                                          processes=None, video_file=None, fps=10):
+    """Creates the same plots as plot_stations_hourly_average, spread over a
+    pool of processes. If video_file is given, the frames are piped into
+    ffmpeg in order instead of being saved as PNGs."""
+    init_args = (station_averages, station_coords, time_interval)
+    frames = range(station_averages.shape[1])
+    with multiprocessing.Pool(processes, init_frame_worker, init_args) as pool:
+        if video_file is None:
+            for index in pool.imap_unordered(save_frame, frames):
+                print("Generated figure:", index)
+            return
+        # measured by a worker, since the workers render with Agg whatever
+        # backend this process has
+        width, height = pool.apply(get_frame_size)
+        encoder = subprocess.Popen(['ffmpeg', '-y', '-loglevel', 'error',
+                                    '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                                    '-s', str(width) + 'x' + str(height), '-r', str(fps),
+                                    '-i', '-', '-pix_fmt', 'yuv420p', video_file],
+                                   stdin=subprocess.PIPE)
+        try:
+            for index, frame in enumerate(pool.imap(render_frame, frames)):
+                encoder.stdin.write(frame)
+                print("Encoded frame:", index)
+        finally:
+            encoder.stdin.close()
+            encoder.wait()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=None,
+                        help="number of processes to read the logs and render with, "
+                             "1 does everything in this process")
+    parser.add_argument('--video', default=None,
+                        help="encode the frames into this video file with ffmpeg instead of saving PNGs")
+    args = parser.parse_args()
     # To plot station data via GPS coordinates and station occupancy
-    time_interval = get_time_interval()
-    station_info = get_station_info()
-    station_coords = parse_station_coordinates(station_info)
-    station_occupancy_array = get_station_occupancy_array()
-    station_averages = get_station_hourly_average(station_occupancy_array)
-    plot_stations_hourly_average(station_averages, station_coords, time_interval)
+    time_interval = occupancy.get_time_interval()
+    station_numbers = occupancy.get_station_numbers()
+    station_occupancy_array = occupancy.build_occupancy_matrix(station_numbers, time_interval,
+                                                               processes=args.processes)
+    station_coords, found = station_info.get_station_coords(station_numbers)
+    # the matrix has a row per station number, so pick out the stations
+    # that have coordinates, in the same order as station_coords
+    station_averages = get_station_hourly_average(station_occupancy_array[station_coords[0]])
+    if args.processes == 1 and args.video is None:
+        plot_stations_hourly_average(station_averages, station_coords, time_interval)
+    else:
+        plot_stations_hourly_average_parallel(station_averages, station_coords, time_interval,
+                                              args.processes, args.video)
@@ -0,0 +1,67 @@
+"""Station activity computed from the bike counts in the station logs.
+
+Activity is counted in bikes rather than log lines: every drop in the
+number of bikes at a station between two consecutive snapshots counts as
+that many checkouts, and every rise as that many returns. Disabled bikes
+are counted along with available ones, so a bike being taken out of
+service doesn't look like a checkout. Rebalancing trucks do show up as
+activity, since the feed can't tell them apart from riders."""
+
+import numpy as np
+from occupancy import get_station_numbers, read_station_records
+
+HOUR = 3600
+
+
+def read_station_bikes(station_number, data_dir='../data/', time_interval=None):
+    """Returns arrays of a station's last_reported times and the number of
+    bikes docked there at each of them"""
+    times = []
+    bikes = []
+    for line in read_station_records(station_number, data_dir, time_interval):
+        times.append(int(line['l_r']))
+        bikes.append(line['n_b_a'] + (line['n_b_d'] or 0))
+    return np.array(times, dtype=np.int64), np.array(bikes, dtype=np.int32)
+
+
+def get_bike_deltas(bikes):
+    """Returns the checkouts and returns between consecutive snapshots"""
+    deltas = np.diff(bikes)
+    return np.maximum(-deltas, 0), np.maximum(deltas, 0)
+
+
+def get_station_activity(station_numbers=None, data_dir='../data/'):
+    """Returns the station numbers and the total checkouts and returns of
+    every station, as arrays"""
+    if station_numbers is None:
+        station_numbers = get_station_numbers(data_dir)
+    checkouts = np.zeros(len(station_numbers), dtype=np.int64)
+    returns = np.zeros(len(station_numbers), dtype=np.int64)
+    for row, station_number in enumerate(station_numbers):
+        station_checkouts, station_returns = get_bike_deltas(read_station_bikes(station_number, data_dir)[1])
+        checkouts[row] = station_checkouts.sum()
+        returns[row] = station_returns.sum()
+    return np.array(station_numbers), checkouts, returns
+
+
+def get_hourly_activity(time_interval, station_numbers=None, data_dir='../data/'):
+    """Returns the station numbers, the epoch time of every hour of the time
+    interval and two stations x hours arrays of checkouts and returns.
+
+    A change is counted in the hour of the snapshot that shows it, and
+    changes shown by snapshots outside the interval aren't counted. The
+    first change inside it is taken from the last snapshot before it."""
+    if station_numbers is None:
+        station_numbers = get_station_numbers(data_dir)
+    num_hours = int((time_interval[1] - time_interval[0]) / HOUR) + 1
+    checkouts = np.zeros((len(station_numbers), num_hours), dtype=np.int32)
+    returns = np.zeros((len(station_numbers), num_hours), dtype=np.int32)
+    for row, station_number in enumerate(station_numbers):
+        times, bikes = read_station_bikes(station_number, data_dir, time_interval)
+        station_checkouts, station_returns = get_bike_deltas(bikes)
+        inside = (times[1:] >= time_interval[0]) & (times[1:] <= time_interval[1])
+        hours = (times[1:][inside] - time_interval[0]) // HOUR
+        np.add.at(checkouts[row], hours, station_checkouts[inside])
+        np.add.at(returns[row], hours, station_returns[inside])
+    hour_times = time_interval[0] + HOUR * np.arange(num_hours)
+    return np.array(station_numbers), hour_times, checkouts, returns
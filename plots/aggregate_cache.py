@@ -0,0 +1,217 @@
+"""Persistent cache of per-station, per-hour occupancy aggregates.
+
+For every station the cache keeps, per hour since the first reading, the
+sum of occupancy x seconds and the number of seconds covered, along with
+the byte offset of the station's log that has been consumed so far. Each
+run only reads the bytes appended to a log since the last run and folds
+them into the sums, so refreshing the cache costs as much as the new data
+rather than the whole history.
+
+A reading holds from its last_reported time until the next reading, so
+the time after a station's latest reading isn't folded in until the next
+reading arrives. get_hourly_means() and get_station_averages() can count
+that open stretch up to a given time without storing it.
+
+The offsets count bytes since the start of a log as it was before any
+rotation, so when rotation.py seals part of a log, the offset into the
+shorter active log is the stored one minus the bytes rotated out. Records
+that were sealed before the cache read them are read back from the
+archive, starting after the station's last folded reading."""
+
+import os
+import sys
+import json
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import rotation
+import storage
+
+CACHE_FILE = 'aggregate_cache.npz'
+HOUR = 3600
+
+
+def make_cache():
+    """Returns an empty cache"""
+    return {
+        'station_ids': np.zeros(0, dtype=np.int64),
+        'offsets': np.zeros(0, dtype=np.int64),
+        'last_time': np.zeros(0, dtype=np.int64),
+        'last_value': np.zeros(0, dtype=np.float64),
+        'base_hour': np.int64(-1),
+        'sums': np.zeros((0, 0), dtype=np.float64),
+        'seconds': np.zeros((0, 0), dtype=np.float64),
+    }
+
+
+def load_cache(file_name=CACHE_FILE):
+    """Loads the cache from file_name, or returns an empty cache"""
+    return storage.load_table(file_name, make_cache)
+
+
+def save_cache(cache, file_name=CACHE_FILE):
+    """Saves the cache"""
+    storage.save_table(cache, file_name)
+
+
+def get_station_row(cache, station_id):
+    """Returns the row of station_id in the cache, adding a row for it if
+    the cache hasn't seen it before"""
+    return storage.get_station_row(cache, station_id, {
+        'offsets': 0, 'last_time': -1, 'last_value': 0, 'sums': 0, 'seconds': 0})
+
+
+def cover_hours(cache, first_time, last_time):
+    """Grows the hour columns of the cache to cover first_time..last_time"""
+    first_hour = first_time // HOUR
+    last_hour = last_time // HOUR
+    if cache['base_hour'] < 0:
+        cache['base_hour'] = np.int64(first_hour)
+    before = max(0, int(cache['base_hour'] - first_hour))
+    after = max(0, int(last_hour - cache['base_hour']) + 1 - cache['sums'].shape[1])
+    if before or after:
+        cache['sums'] = np.pad(cache['sums'], ((0, 0), (before, after)))
+        cache['seconds'] = np.pad(cache['seconds'], ((0, 0), (before, after)))
+        cache['base_hour'] = np.int64(cache['base_hour'] - before)
+
+
+def get_occupancy(record):
+    """Returns the fraction of a station's docks that hold a bike"""
+    total = record['n_b_a'] + record['n_d_a']
+    return record['n_b_a'] / total if total else 0
+
+
+def read_sealed_readings(file_name, after):
+    """Reads the records of a log that were sealed into the archive after
+    time after. Returns arrays of their times and occupancies."""
+    times = []
+    values = []
+    for line in rotation.iter_lines(file_name, after if after >= 0 else None, active=False):
+        record = json.loads(line)
+        if int(record['l_r']) > after:
+            times.append(int(record['l_r']))
+            values.append(get_occupancy(record))
+    return np.array(times, dtype=np.int64), np.array(values)
+
+
+def read_new_readings(file_name, offset):
+    """Reads the records appended to a log after offset.
+
+    Returns arrays of their times and occupancies, and the offset just past
+    the last complete record. A torn trailing record is left for later."""
+    with open(file_name, 'rb') as readfile:
+        readfile.seek(offset)
+        new_bytes = readfile.read()
+    times = []
+    values = []
+    consumed = 0
+    position = 0
+    for line in new_bytes.split(b'\n'):
+        position += len(line) + 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        times.append(int(record['l_r']))
+        values.append(get_occupancy(record))
+        consumed = min(position, len(new_bytes))
+    return np.array(times, dtype=np.int64), np.array(values), offset + consumed
+
+
+def fold_readings(cache, row, times, values):
+    """Folds a station's new readings into its hourly sums.
+
+    The occupancy integral is piecewise linear between readings, so its
+    value at every hour boundary comes from one np.interp call."""
+    if cache['last_time'][row] >= 0:
+        times = np.insert(times, 0, cache['last_time'][row])
+        values = np.insert(values, 0, cache['last_value'][row])
+    times = np.maximum.accumulate(times)
+    cache['last_time'][row] = times[-1]
+    cache['last_value'][row] = values[-1]
+    if len(times) < 2:
+        return
+    cover_hours(cache, times[0], times[-1])
+    integral = np.concatenate(([0], np.cumsum(values[:-1] * np.diff(times))))
+    first_hour = times[0] // HOUR
+    edges = np.arange(first_hour, times[-1] // HOUR + 2) * HOUR
+    edges = np.clip(edges, times[0], times[-1])
+    column = int(first_hour - cache['base_hour'])
+    count = len(edges) - 1
+    cache['sums'][row, column:column + count] += np.diff(np.interp(edges, times, integral))
+    cache['seconds'][row, column:column + count] += np.diff(edges)
+
+
+def update_cache(cache, data_dir='../data/'):
+    """Folds every record appended to the station logs since the last update
+    into the cache. Returns how many records were folded in."""
+    folded = 0
+    for file_name in os.listdir(data_dir):
+        if not (file_name[:-4].isdigit() and file_name.endswith('.txt')):
+            continue
+        row = get_station_row(cache, int(file_name[:-4]))
+        path = os.path.join(data_dir, file_name)
+        rotated_bytes = rotation.get_rotated_bytes(path)
+        offset = cache['offsets'][row] - rotated_bytes
+        if os.path.getsize(path) < offset:
+            # the log was replaced, so start the station over
+            offset = -rotated_bytes
+            cache['last_time'][row] = -1
+            cache['sums'][row] = 0
+            cache['seconds'][row] = 0
+        if offset < 0:
+            # part of what hasn't been read yet has been sealed since
+            times, values = read_sealed_readings(path, cache['last_time'][row])
+            if len(times):
+                fold_readings(cache, row, times, values)
+                folded += len(times)
+            offset = 0
+        times, values, offset = read_new_readings(path, offset)
+        cache['offsets'][row] = offset + rotated_bytes
+        if len(times):
+            fold_readings(cache, row, times, values)
+            folded += len(times)
+    return folded
+
+
+def refresh_cache(data_dir='../data/', file_name=CACHE_FILE):
+    """Loads the cache, folds in anything new and saves it"""
+    cache = load_cache(file_name)
+    if update_cache(cache, data_dir):
+        save_cache(cache, file_name)
+    return cache
+
+
+def get_hourly_totals(cache, until=None):
+    """Returns copies of the sums and seconds, with the stretch from every
+    station's last reading up to until folded in"""
+    sums = cache['sums'].copy()
+    seconds = cache['seconds'].copy()
+    if until is None:
+        return sums, seconds
+    tail = {'sums': sums, 'seconds': seconds, 'base_hour': cache['base_hour'],
+            'last_time': cache['last_time'].copy(), 'last_value': cache['last_value'].copy()}
+    for row in range(len(cache['station_ids'])):
+        if 0 <= tail['last_time'][row] < until:
+            fold_readings(tail, row, np.array([until]), np.array([0.0]))
+    return tail['sums'], tail['seconds']
+
+
+def get_hourly_means(cache, until=None):
+    """Returns the station_ids, the epoch time of every hour and the mean
+    occupancy of every station for every hour, NaN where it didn't report"""
+    sums, seconds = get_hourly_totals(cache, until)
+    hours = (cache['base_hour'] + np.arange(sums.shape[1])) * HOUR
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cache['station_ids'], hours, sums / seconds
+
+
+def get_station_averages(cache, until=None):
+    """Returns the station_ids and the mean occupancy of every station over
+    all the time it has been reporting"""
+    sums, seconds = get_hourly_totals(cache, until)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cache['station_ids'], sums.sum(axis=1) / seconds.sum(axis=1)
@@ -0,0 +1,188 @@
+"""Shared engine for building the station occupancy matrix.
+
+The matrix has one row per station number and one column per 10 second
+bin of the time interval in last_updated.txt. A cell holds the fraction
+of the station's docks that had a bike in it, reported in that bin, or 2
+if the station didn't report in that bin. Row 0 is never filled, so that
+the row number is the station number.
+
+Logs that rotation.py has sealed into day partitions are read through it,
+so only the partitions that overlap the time interval are decompressed.
+
+Reading the logs is most of the work, and every station's log is separate,
+so build_occupancy_matrix() can spread the stations over a pool of
+processes. They fill in their stations' rows of one matrix in shared
+memory, so nothing but station numbers goes through the pool's pipes."""
+
+import os
+import re
+import sys
+import json
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import rotation
+
+BIN_SECONDS = 10
+NO_READING = 2
+# last_reported, num_bikes_available and num_docks_available as hub_where.py
+# writes them
+READING_PATTERNS = (re.compile(r'"l_r": "?(\d+)'),
+                    re.compile(r'"n_b_a": (\d+)'),
+                    re.compile(r'"n_d_a": (\d+)'))
+
+# the shared matrix a loading process fills in, set up by init_load_worker()
+load_state = {}
+
+
+def get_time_interval(last_updated_file='../last_updated.txt'):
+    """Function to get the time interval where data was collected from
+    last_updated.txt and its sealed partitions"""
+    return rotation.get_bounds(last_updated_file)
+
+
+def get_station_numbers(data_dir='../data/'):
+    """Returns the sorted station numbers that have a log in data_dir"""
+    station_numbers = []
+    for file_name in os.listdir(data_dir):
+        if file_name[:-4].isdigit() and file_name.endswith('.txt'):
+            station_numbers.append(int(file_name[:-4]))
+    return sorted(station_numbers)
+
+
+def get_num_bins(time_interval):
+    """Returns how many bins the time interval is split into"""
+    return int((time_interval[1] - time_interval[0]) / BIN_SECONDS) + 1
+
+
+def read_station_records(station_number, data_dir='../data/', time_interval=None):
+    """Yields the records of one station's log, sealed and active. With a
+    time interval, only the partitions that overlap it are read, along with
+    the one holding the station's state at its start."""
+    t0, t1 = time_interval if time_interval is not None else (None, None)
+    for next_line in rotation.iter_lines(data_dir + str(station_number) + '.txt', t0, t1):
+        yield json.loads(next_line)
+
+
+def parse_readings(lines):
+    """Returns arrays of the last_reported times, bike counts and dock
+    counts in a list of record lines.
+
+    The fields are picked out of all the lines at once with regular
+    expressions, which is several times faster than json.loads() per line.
+    If the lines don't hold one of each per record, they are parsed as
+    JSON instead."""
+    text = '\n'.join(lines)
+    fields = [pattern.findall(text) for pattern in READING_PATTERNS]
+    if any(len(values) != len(lines) for values in fields):
+        records = [json.loads(line) for line in lines]
+        fields = [[int(record['l_r']) for record in records],
+                  [record['n_b_a'] for record in records],
+                  [record['n_d_a'] for record in records]]
+    return [np.fromiter(map(int, values), np.int64, len(values)) for values in fields]
+
+
+def read_station_readings(station_number, data_dir='../data/', time_interval=None):
+    """Reads one station's log and returns arrays of its last_reported
+    times and occupancies. Both are empty if the station has no log."""
+    t0, t1 = time_interval if time_interval is not None else (None, None)
+    lines = list(rotation.iter_lines(data_dir + str(station_number) + '.txt', t0, t1))
+    times, bikes, docks = parse_readings(lines)
+    bikes = bikes.astype(np.float32)
+    total = bikes + docks.astype(np.float32)
+    occupancy = np.divide(bikes, total, out=np.zeros_like(bikes), where=total != 0)
+    return np.array(times, dtype=np.int64), occupancy
+
+
+def build_occupancy_matrix(station_numbers=range(1, 219), time_interval=None,
+                           data_dir='../data/', processes=1):
+    """Gets how full the stations are over time as a float32 matrix.
+
+    The matrix is allocated once and every station's readings are put in
+    place with one scatter. Readings from before the interval go in the
+    first bin, and when a station reported twice in one bin the later
+    reading wins.
+
+    With processes other than 1, the logs are read by that many processes,
+    or one per core if it's None."""
+    if time_interval is None:
+        time_interval = get_time_interval(data_dir + '../last_updated.txt')
+    if processes != 1:
+        return build_occupancy_matrix_parallel(station_numbers, time_interval, data_dir, processes)
+    num_bins = get_num_bins(time_interval)
+    matrix = np.full((max(station_numbers) + 1, num_bins), NO_READING, dtype=np.float32)
+    rows = []
+    columns = []
+    values = []
+    for station_number in station_numbers:
+        times, occupancy = read_station_readings(station_number, data_dir, time_interval)
+        rows.append(np.full(len(times), station_number, dtype=np.int64))
+        columns.append(np.maximum((times - time_interval[0]) // BIN_SECONDS, 0))
+        values.append(occupancy)
+    rows = np.concatenate(rows)
+    columns = np.concatenate(columns)
+    values = np.concatenate(values)
+    in_range = columns < num_bins
+    rows, columns, values = rows[in_range], columns[in_range], values[in_range]
+    # keep only the last reading of every cell, since NumPy doesn't promise
+    # which of several writes to the same cell wins
+    cells = rows * num_bins + columns
+    _, last = np.unique(cells[::-1], return_index=True)
+    last = len(cells) - 1 - last
+    matrix[rows[last], columns[last]] = values[last]
+    return matrix
+
+
+def fill_station_row(row, times, occupancy, time_interval):
+    """Puts one station's readings into its row of the occupancy matrix,
+    the same way build_occupancy_matrix() does"""
+    columns = np.maximum((times - time_interval[0]) // BIN_SECONDS, 0)
+    in_range = columns < len(row)
+    columns, occupancy = columns[in_range], occupancy[in_range]
+    _, last = np.unique(columns[::-1], return_index=True)
+    last = len(columns) - 1 - last
+    row[columns[last]] = occupancy[last]
+
+
+def init_load_worker(memory_name, shape, time_interval, data_dir):
+    """Attaches a loading process to the shared occupancy matrix"""
+    memory = shared_memory.SharedMemory(memory_name)
+    load_state['memory'] = memory
+    load_state['matrix'] = np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+    load_state['time_interval'] = time_interval
+    load_state['data_dir'] = data_dir
+
+
+def load_station(station_number):
+    """Reads one station's log in a loading process and writes its readings
+    straight into its row of the shared matrix. Returns how many there were."""
+    times, occupancy = read_station_readings(station_number, load_state['data_dir'],
+                                             load_state['time_interval'])
+    fill_station_row(load_state['matrix'][station_number], times, occupancy,
+                     load_state['time_interval'])
+    return len(times)
+
+
+def build_occupancy_matrix_parallel(station_numbers, time_interval, data_dir='../data/',
+                                    processes=None):
+    """Builds the same matrix as build_occupancy_matrix(), with the station
+    logs read by a pool of processes that write into shared memory"""
+    shape = (max(station_numbers) + 1, get_num_bins(time_interval))
+    memory = shared_memory.SharedMemory(create=True, size=shape[0] * shape[1] * 4)
+    try:
+        shared = np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+        shared.fill(NO_READING)
+        init_args = (memory.name, shape, time_interval, data_dir)
+        with multiprocessing.Pool(processes, init_load_worker, init_args) as pool:
+            for _ in pool.imap_unordered(load_station, station_numbers):
+                pass
+        matrix = shared.copy()
+        # the buffer can't be released while an array still points into it
+        del shared
+    finally:
+        memory.close()
+        memory.unlink()
+    return matrix
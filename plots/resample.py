@@ -0,0 +1,58 @@
+"""Resampling of the occupancy matrix built by occupancy.py.
+
+Every function works on the whole stations x bins matrix at once. Cells
+holding occupancy.NO_READING mean the station didn't report in that bin,
+so it still had whatever it reported last. Since every bin is the same
+length, the mean of a forward-filled row over a window is the time-
+weighted mean occupancy of the station over that window."""
+
+import numpy as np
+from occupancy import BIN_SECONDS, NO_READING
+
+HOUR = 3600
+QUARTER_HOUR = 900
+DAY = 86400
+
+
+def forward_fill(matrix, initial=0):
+    """Replaces every NO_READING cell with the last reading before it in the
+    same row. Cells before a row's first reading are set to initial."""
+    has_reading = matrix != NO_READING
+    last_reading = np.where(has_reading, np.arange(matrix.shape[1], dtype=np.int32), -1)
+    np.maximum.accumulate(last_reading, axis=1, out=last_reading)
+    rows = np.arange(matrix.shape[0])[:, np.newaxis]
+    filled = matrix[rows, np.maximum(last_reading, 0)]
+    filled[last_reading < 0] = initial
+    return filled
+
+
+def window_means(filled, window_seconds=HOUR, bin_seconds=BIN_SECONDS):
+    """Returns the mean of every window of window_seconds in every row of a
+    forward-filled matrix. The last window may be shorter than the rest,
+    and is averaged over its own length."""
+    window_bins = max(1, int(window_seconds / bin_seconds))
+    starts = np.arange(0, filled.shape[1], window_bins)
+    sums = np.add.reduceat(filled, starts, axis=1, dtype=np.float64)
+    lengths = np.diff(np.append(starts, filled.shape[1]))
+    return sums / lengths
+
+
+def station_means(matrix):
+    """Returns the time-weighted mean occupancy of every row of an
+    occupancy matrix over its whole interval"""
+    return forward_fill(matrix).mean(axis=1, dtype=np.float64)
+
+
+def hourly_means(matrix):
+    """Returns the mean occupancy of every row for every hour"""
+    return window_means(forward_fill(matrix), HOUR)
+
+
+def quarter_hourly_means(matrix):
+    """Returns the mean occupancy of every row for every 15 minutes"""
+    return window_means(forward_fill(matrix), QUARTER_HOUR)
+
+
+def daily_means(matrix):
+    """Returns the mean occupancy of every row for every day"""
+    return window_means(forward_fill(matrix), DAY)
@@ -0,0 +1,88 @@
+"""Local cache of Hubway's station_information feed.
+
+The feed is saved to station_information.json in the top directory, which
+async_collector.py keeps up to date as well, and is only fetched again
+once the saved copy is older than max_age seconds. The station locations
+are turned into a coordinate table keyed by station_id, so that metrics
+are matched to stations by ID rather than by their position in a list."""
+
+import os
+import sys
+import json
+import time
+import requests
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import storage
+
+STATION_INFO_URL = 'https://api-core.thehubway.com/gbfs/en/station_information.json'
+CACHE_FILE = '../station_information.json'
+MAX_AGE = 86400
+
+COORDINATE_DTYPE = np.dtype([('station_id', np.int64), ('lat', np.float64), ('lon', np.float64)])
+
+# station info already loaded by this process, by cache file
+loaded_station_info = {}
+
+
+def fetch_station_info(url=STATION_INFO_URL):
+    """Gets the station info and returns it as a dict."""
+    station_info = requests.get(url, timeout=10)
+    station_info.raise_for_status()
+    return station_info.json()
+
+
+def save_station_info(station_info, file_name=CACHE_FILE):
+    """Saves the station info to the cache file"""
+    with storage.replace_file(file_name, 'w') as workfile:
+        json.dump(station_info, workfile)
+
+
+def get_station_info(max_age=MAX_AGE, file_name=CACHE_FILE, url=STATION_INFO_URL):
+    """Returns the station info, from this process's memory, from the cache
+    file if it's younger than max_age seconds, or else from the network.
+    Falls back to a stale cache file if the network fetch fails."""
+    if file_name in loaded_station_info:
+        return loaded_station_info[file_name]
+    cache_exists = os.path.exists(file_name)
+    if not cache_exists or time.time() - os.path.getmtime(file_name) > max_age:
+        try:
+            save_station_info(fetch_station_info(url), file_name)
+        except (requests.RequestException, ValueError) as error:
+            if not cache_exists:
+                raise
+            print("Using stale station info, fetch failed:", repr(error))
+    with open(file_name, 'r') as readfile:
+        loaded_station_info[file_name] = json.load(readfile)
+    return loaded_station_info[file_name]
+
+
+def get_coordinate_table(station_info=None):
+    """Returns a structured array of (station_id, lat, lon), sorted by
+    station_id"""
+    if station_info is None:
+        station_info = get_station_info()
+    stations = station_info['data']['stations']
+    table = np.zeros(len(stations), dtype=COORDINATE_DTYPE)
+    table['station_id'] = [int(station['station_id']) for station in stations]
+    table['lat'] = [station['lat'] for station in stations]
+    table['lon'] = [station['lon'] for station in stations]
+    return np.sort(table, order='station_id')
+
+
+def get_station_coords(station_ids, table=None):
+    """Looks up the coordinates of station_ids in the coordinate table.
+
+    Returns [station_ids, lats, lons] for the stations that were found, in
+    the order of station_ids, and a boolean array of which station_ids were
+    found, to filter the metrics that go with station_ids."""
+    if table is None:
+        table = get_coordinate_table()
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+    rows = np.searchsorted(table['station_id'], station_ids)
+    rows = np.minimum(rows, len(table) - 1)
+    found = table['station_id'][rows] == station_ids
+    rows = rows[found]
+    return [station_ids[found], table['lat'][rows], table['lon'][rows]], found
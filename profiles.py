@@ -0,0 +1,307 @@
+"""Per-station occupancy profiles, for asking when a station is usually empty.
+
+A profile counts, for every station, day of the week and hour of the day
+(in local time), how many minutes the station spent at every occupancy
+level:
+    level 0.........No bikes at all
+    level 1-10......Up to 10%, 20%, ... 100% of the docks hold a bike
+From the counts come the chance that a station is empty at a given time
+and the percentiles of its occupancy, in constant time. The profile is an
+array of station x 7 x 24 x 11 counts saved in profiles.npz, along with
+the time it has been sampled up to.
+
+update_from_logs() samples the state of every station once a minute from
+the logs, only for the minutes since the profile was last sampled, so it
+can be run again to catch up. A minute is only sampled if the feed was
+polled within MAX_GAP seconds after it, going by last_updated.txt, so
+that the minutes the collector was down or the feed was out aren't
+filled in with whatever state the stations were last seen in. Once profiles.npz exists, hub_where.py keeps
+it up to date as it polls, and check_poll() compares each poll with the
+profile.
+
+Usage:
+    python profiles.py
+samples the logs into profiles.npz, and
+    python profiles.py 65 [time]
+also prints when station 65 is usually empty, and whether it's likely to
+be at the given epoch time, or now."""
+
+import os
+import sys
+import json
+import time
+import numpy as np
+import rotation
+import delta_codec
+import storage
+
+PROFILE_FILE = 'profiles.npz'
+SAMPLE_SECONDS = 60
+DAYS = 7
+HOURS = 24
+LEVELS = 11
+# how long after a minute the feed has to have been polled for the minute
+# to be sampled
+MAX_GAP = 120
+DAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+# profiles already loaded by this process, by file name, along with the
+# modification time they were loaded at and their rows by station_id
+loaded_profiles = {}
+
+
+def make_profile():
+    """Returns an empty profile"""
+    return {
+        'station_ids': np.zeros(0, dtype=np.int64),
+        'counts': np.zeros((0, DAYS, HOURS, LEVELS), dtype=np.uint32),
+        'sampled_until': np.int64(-1),
+    }
+
+
+def load_profile(file_name=PROFILE_FILE):
+    """Loads the profile from file_name, or returns an empty profile"""
+    return storage.load_table(file_name, make_profile)
+
+
+def save_profile(profile, file_name=PROFILE_FILE):
+    """Saves the profile, compressed since most of its counts are zero"""
+    storage.save_table(profile, file_name, compressed=True)
+
+
+def get_profile(file_name=PROFILE_FILE):
+    """Returns the profile in file_name and a dict of its rows by
+    station_id. A profile that hasn't changed since this process last
+    loaded it is shared rather than loaded again, so it must not be
+    modified."""
+    mtime = os.stat(file_name).st_mtime_ns if os.path.exists(file_name) else None
+    if loaded_profiles.get(file_name, (None,))[0] != mtime or mtime is None:
+        profile = load_profile(file_name)
+        rows = {str(station_id): row for row, station_id in enumerate(profile['station_ids'])}
+        loaded_profiles[file_name] = (mtime, profile, rows)
+    return loaded_profiles[file_name][1:]
+
+
+def get_station_row(profile, station_id):
+    """Returns the row of station_id in the profile, adding a row for it if
+    the profile hasn't seen it before"""
+    return storage.get_station_row(profile, station_id, {'counts': 0})
+
+
+def get_levels(bikes, docks):
+    """Returns the occupancy level of bike and dock counts, which can be
+    arrays: 0 if there are no bikes, otherwise the tenth of the docks the
+    bikes fill, rounded up"""
+    bikes = np.asarray(bikes, dtype=np.float64)
+    total = bikes + np.asarray(docks, dtype=np.float64)
+    occupancy = np.divide(bikes, total, out=np.zeros_like(bikes), where=total != 0)
+    return np.where(bikes > 0, np.clip(np.ceil(occupancy * (LEVELS - 1)), 1, LEVELS - 1),
+                    0).astype(np.int64)
+
+
+def get_cell(t):
+    """Returns the day of the week and hour of the day of time t, in local
+    time"""
+    local = time.localtime(t)
+    return local.tm_wday, local.tm_hour
+
+
+def get_cells(times):
+    """Returns the flat day and hour index into a station's counts of every
+    time. The local time is only worked out once per hour."""
+    hours = np.asarray(times, dtype=np.int64) // 3600
+    unique_hours, inverse = np.unique(hours, return_inverse=True)
+    cells = np.array([day * HOURS + hour for day, hour in
+                      (get_cell(int(x) * 3600) for x in unique_hours)], dtype=np.int64)
+    return cells[inverse]
+
+
+def read_station_levels(file_name, t0=None, t1=None):
+    """Returns arrays of the last_reported times and occupancy levels of a
+    station's log, .txt or .dlt, with the last record as a dict"""
+    if file_name.endswith('.dlt'):
+        records = list(delta_codec.iter_records(file_name))
+    else:
+        records = [json.loads(line) for line in rotation.iter_lines(file_name, t0, t1)]
+    times = np.array([int(record['l_r']) for record in records], dtype=np.int64)
+    levels = get_levels([record['n_b_a'] for record in records],
+                        [record['n_d_a'] for record in records])
+    return times, levels, records[-1] if records else None
+
+
+def fold_levels(profile, row, samples, cells, times, levels):
+    """Counts the level a station was at for every sample time, which is
+    the level of its last record at or before it"""
+    positions = np.searchsorted(times, samples, side='right') - 1
+    known = positions >= 0
+    flat = cells[known] * LEVELS + levels[positions[known]]
+    counts = np.bincount(flat, minlength=DAYS * HOURS * LEVELS)
+    profile['counts'][row] += counts.reshape(DAYS, HOURS, LEVELS).astype(np.uint32)
+
+
+def get_sample_times(profile, first, last):
+    """Returns the sample times from after the profile was last sampled (or
+    from first, for an empty profile) up to last"""
+    if profile['sampled_until'] >= 0:
+        first = int(profile['sampled_until']) + 1
+    start = -(-first // SAMPLE_SECONDS) * SAMPLE_SECONDS
+    return np.arange(start, last + 1, SAMPLE_SECONDS, dtype=np.int64)
+
+
+def drop_unpolled(samples, poll_times):
+    """Returns the sample times that the feed was polled within MAX_GAP
+    seconds after, out of sorted sample and poll times"""
+    following = np.searchsorted(poll_times, samples, side='left')
+    polled = following < len(poll_times)
+    polled[polled] = poll_times[following[polled]] - samples[polled] < MAX_GAP
+    return samples[polled]
+
+
+def update_from_logs(profile, data_dir='data/', last_updated_file='last_updated.txt',
+                     encoding='json'):
+    """Samples the station logs into the profile, from where it was last
+    sampled up to the last logged last_updated time.
+
+    Returns the last record of every station, by station_id, to carry on
+    sampling from polls."""
+    bounds = rotation.get_bounds(last_updated_file) if os.path.exists(last_updated_file) else None
+    extension = '.dlt' if encoding == 'delta' else '.txt'
+    file_names = [x for x in os.listdir(data_dir) if x[:-4].isdigit() and x.endswith(extension)]
+    samples = np.zeros(0, dtype=np.int64)
+    t0 = t1 = None
+    if bounds is not None:
+        samples = get_sample_times(profile, bounds[0], bounds[1])
+        # with nothing to sample, only the last records are needed
+        t0, t1 = (int(samples[0]), int(samples[-1])) if len(samples) else (bounds[1], bounds[1])
+    if len(samples):
+        profile['sampled_until'] = np.int64(samples[-1])
+        poll_times = np.array([int(line) for line in rotation.iter_lines(
+            last_updated_file, int(samples[0]), int(samples[-1]) + MAX_GAP)], dtype=np.int64)
+        samples = drop_unpolled(samples, np.sort(poll_times))
+    cells = get_cells(samples)
+    states = {}
+    for file_name in file_names:
+        times, levels, last_record = read_station_levels(os.path.join(data_dir, file_name), t0, t1)
+        if last_record is None:
+            continue
+        states[file_name[:-4]] = last_record
+        if len(samples):
+            row = get_station_row(profile, file_name[:-4])
+            fold_levels(profile, row, samples, cells, times, levels)
+    return states
+
+
+def sample_states(profile, states, t):
+    """Counts the current state of every station, as polled at time t, for
+    the sample times from where the profile was last sampled up to t, going
+    back no further than MAX_GAP seconds. Returns how many sample times
+    that was."""
+    samples = get_sample_times(profile, t - MAX_GAP, t)
+    if not len(samples):
+        return 0
+    profile['sampled_until'] = np.int64(samples[-1])
+    samples = drop_unpolled(samples, np.array([t], dtype=np.int64))
+    cells = get_cells(samples)
+    for station_id, record in states.items():
+        row = get_station_row(profile, station_id)
+        level = get_levels(record['n_b_a'], record['n_d_a'])
+        np.add.at(profile['counts'][row].reshape(DAYS * HOURS, LEVELS), (cells, level), 1)
+    return len(samples)
+
+
+def get_counts(station, when=None, file_name=PROFILE_FILE):
+    """Returns the counts of every level for a station at the day and hour
+    of time when, or now"""
+    profile, rows = get_profile(file_name)
+    if str(station) not in rows:
+        raise KeyError('no profile for station ' + str(station))
+    day, hour = get_cell(time.time() if when is None else when)
+    return profile['counts'][rows[str(station)], day, hour]
+
+
+def get_empty_chance(station, when=None, file_name=PROFILE_FILE):
+    """Returns how often a station has been empty at the day and hour of
+    time when, or None if it was never sampled then"""
+    counts = get_counts(station, when, file_name)
+    total = counts.sum()
+    return counts[0] / total if total else None
+
+
+def likely_empty(station, when=None, threshold=0.5, file_name=PROFILE_FILE):
+    """Returns True if a station has been empty at least threshold of the
+    time at the day and hour of time when, or now"""
+    chance = get_empty_chance(station, when, file_name)
+    return chance is not None and chance >= threshold
+
+
+def get_percentiles(station, when=None, percentiles=(10, 50, 90), file_name=PROFILE_FILE):
+    """Returns the occupancy at each percentile for a station at the day
+    and hour of time when, as the top of its level, or None if it was
+    never sampled then"""
+    counts = get_counts(station, when, file_name)
+    total = counts.sum()
+    if not total:
+        return None
+    cumulative = np.cumsum(counts)
+    return [int(np.searchsorted(cumulative, total * p / 100)) / (LEVELS - 1) for p in percentiles]
+
+
+def check_poll(profile, states, t, station_ids=None, threshold=0.5, unusual=0.1):
+    """Compares the current state of stations with the profile.
+
+    Returns (station_id, kind, chance) for every station that is empty when
+    it is empty less than unusual of the time ('unusually empty'), or isn't
+    empty when it is empty at least threshold of the time ('likely empty'),
+    where chance is how often it has been empty at that day and hour."""
+    day, hour = get_cell(t)
+    rows = {str(station_id): row for row, station_id in enumerate(profile['station_ids'])}
+    alerts = []
+    for station_id in (states if station_ids is None else station_ids):
+        if station_id not in states or station_id not in rows:
+            continue
+        counts = profile['counts'][rows[station_id], day, hour]
+        total = counts.sum()
+        if not total:
+            continue
+        chance = counts[0] / total
+        empty = states[station_id]['n_b_a'] == 0
+        if empty and chance < unusual:
+            alerts.append((station_id, 'unusually empty', chance))
+        elif not empty and chance >= threshold:
+            alerts.append((station_id, 'likely empty', chance))
+    return alerts
+
+
+def format_station(station, file_name=PROFILE_FILE):
+    """Returns a table of how often a station has been empty at every day
+    and hour, as a digit of tenths, or '.' where it was never sampled"""
+    profile, rows = get_profile(file_name)
+    if str(station) not in rows:
+        raise KeyError('no profile for station ' + str(station))
+    counts = profile['counts'][rows[str(station)]]
+    totals = counts.sum(axis=2)
+    lines = ['    ' + ''.join(str(hour // 10) if hour % 10 == 0 else ' ' for hour in range(HOURS))]
+    for day in range(DAYS):
+        cells = []
+        for hour in range(HOURS):
+            if totals[day, hour]:
+                cells.append(str(min(9, int(counts[day, hour, 0] * 10 // totals[day, hour]))))
+            else:
+                cells.append('.')
+        lines.append(DAY_NAMES[day] + ' ' + ''.join(cells))
+    return '\n'.join(lines)
+
+
+if __name__ == "__main__":
+    profile = load_profile()
+    update_from_logs(profile)
+    save_profile(profile)
+    print("Sampled up to", int(profile['sampled_until']), "for", len(profile['station_ids']),
+          "stations")
+    if len(sys.argv) > 1:
+        station = sys.argv[1]
+        when = int(sys.argv[2]) if len(sys.argv) > 2 else None
+        print("Tenths of the time station", station, "was empty, by local hour:")
+        print(format_station(station))
+        print("Likely empty at", time.ctime(time.time() if when is None else when) + ":",
+              likely_empty(station, when), "(chance " + str(get_empty_chance(station, when)) + ")")
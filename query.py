@@ -0,0 +1,342 @@
+"""Point-in-time and range queries over the station logs.
+
+Next to every data/<station_id>.txt log sits data/<station_id>.idx, a
+flat array of (last_reported, byte offset) pairs, one per record, in the
+order they were logged. Since the collector only logs a station when its
+last_reported grows, the index is sorted by time, and a lookup is a
+binary search in the index followed by one seek into the log.
+update_index() only reads the part of a log that was appended since the
+index was last updated, and hub_where.py calls it as it writes.
+
+History only ever reads the index files, into memory, and checks the log
+on every query. Whatever the collector logged since, or a log that
+rotation has rewritten, is picked up before answering.
+
+The index only covers the active log. Queries for times before its first
+record are answered from the sealed day partitions that rotation.py
+leaves in data/archive/. History decompresses a partition the first time
+a query needs it and keeps its record times and lines in memory, so
+later lookups in it are a binary search as well.
+
+A station that reports again without any change isn't logged, so a state
+holds from its record until the next one. If the collector kept a
+heartbeat log (data/<station_id>.hb), heartbeats() tells when within that
+stretch the station was actually heard from.
+
+Usage:
+    python query.py [port]
+serves the queries as JSON on localhost, for example
+    /state?station=65&t=1475670900
+    /range?station=65&t0=1475670000&t1=1475673600
+    /snapshot?t=1475670900
+    /heartbeats?station=65&t0=1475670000&t1=1475673600"""
+
+import os
+import sys
+import json
+import threading
+from collections import OrderedDict
+import numpy as np
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import rotation
+import storage
+
+INDEX_DTYPE = np.dtype([('l_r', np.int64), ('offset', np.int64)])
+
+
+def get_index_path(log_file):
+    """Returns the path of the index that goes with a station log"""
+    return log_file[:-4] + '.idx'
+
+
+def read_index(log_file):
+    """Reads the index of a station log into memory, or returns an empty
+    one. It is copied rather than memory-mapped, since update_index() may
+    replace the file."""
+    try:
+        with open(get_index_path(log_file), 'rb') as readfile:
+            data = readfile.read()
+    except FileNotFoundError:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.frombuffer(data[:len(data) - len(data) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+
+
+def get_first_time(log_file):
+    """Returns the last_reported time of the first record of a station log,
+    or None if it has none"""
+    with open(log_file, 'rb') as readfile:
+        for line in readfile:
+            if line.strip():
+                try:
+                    return int(json.loads(line)['l_r'])
+                except ValueError:
+                    return None
+    return None
+
+
+def read_new_entries(log_file, index):
+    """Reads the records of a station log that index doesn't cover yet.
+
+    Returns their index entries, and whether the index is for an older or
+    rotated log and has to be started over with them."""
+    log_size = os.path.getsize(log_file)
+    start = 0
+    if len(index):
+        start = int(index['offset'][-1])
+        # an index that points past the end of the log, or that doesn't start
+        # with the log's first record, is for an older or rotated log
+        if start >= log_size or get_first_time(log_file) != index['l_r'][0]:
+            start = 0
+    new_entries = []
+    with open(log_file, 'rb') as readfile:
+        readfile.seek(start)
+        if start:
+            # skip the record the index already ends with
+            readfile.readline()
+        offset = readfile.tell()
+        for line in readfile:
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                new_entries.append((int(record['l_r']), offset))
+            offset += len(line)
+    return np.array(new_entries, dtype=INDEX_DTYPE), start == 0
+
+
+def update_index(log_file):
+    """Adds the records appended to a station log since the last update to
+    its index. Returns how many records were added."""
+    new_entries, restart = read_new_entries(log_file, read_index(log_file))
+    index_file = get_index_path(log_file)
+    if restart:
+        # replaced rather than rewritten in place, for anyone reading it
+        with storage.replace_file(index_file) as workfile:
+            workfile.write(new_entries.tobytes())
+    elif len(new_entries):
+        with open(index_file, 'ab') as workfile:
+            workfile.write(new_entries.tobytes())
+    return len(new_entries)
+
+
+def update_indexes(data_dir='data/'):
+    """Brings the index of every station log in data_dir up to date"""
+    added = 0
+    for file_name in os.listdir(data_dir):
+        if file_name[:-4].isdigit() and file_name.endswith('.txt'):
+            added += update_index(os.path.join(data_dir, file_name))
+    return added
+
+
+class History:
+    """Answers queries about the state of the stations at any time.
+
+    Indexes are loaded the first time a station is queried and kept in
+    memory, along with the size and modification time of the log they
+    cover. Every query checks those against the log and reloads the index
+    if it changed. Up to max_partitions decompressed partitions are kept
+    as well, dropping the least recently used."""
+
+    def __init__(self, data_dir='data/', max_partitions=1024):
+        self.data_dir = data_dir
+        self.indexes = {}
+        self.max_partitions = max_partitions
+        self.partitions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_log_file(self, station):
+        """Returns the log file of a station"""
+        return os.path.join(self.data_dir, str(station) + '.txt')
+
+    def get_index(self, station):
+        """Returns the index of a station, loading it again if its log has
+        changed since it was loaded. Records the collector hasn't indexed
+        yet are indexed in memory, leaving the index file to it."""
+        station = str(station)
+        log_file = self.get_log_file(station)
+        try:
+            stat = os.stat(log_file)
+        except FileNotFoundError:
+            raise KeyError('no log for station ' + station)
+        version = (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if self.indexes.get(station, (None,))[0] != version:
+                index = read_index(log_file)
+                new_entries, restart = read_new_entries(log_file, index)
+                index = new_entries if restart else np.concatenate((index, new_entries))
+                self.indexes[station] = (version, index)
+            return self.indexes[station][1]
+
+    def get_stations(self):
+        """Returns the station_ids that have a log"""
+        return sorted((x[:-4] for x in os.listdir(self.data_dir)
+                       if x[:-4].isdigit() and x.endswith('.txt')), key=int)
+
+    def refresh(self, station=None):
+        """Reloads the index of one station, or of every loaded station"""
+        stations = [str(station)] if station is not None else list(self.indexes)
+        for station in stations:
+            with self.lock:
+                self.indexes.pop(station, None)
+            self.get_index(station)
+
+    def read_records(self, station, entries):
+        """Reads the records of a station's log that the given index
+        entries point at. Raises ValueError if the log has been rewritten
+        since, so that they point at something else."""
+        records = []
+        with open(self.get_log_file(station), 'rb') as readfile:
+            for entry in entries:
+                readfile.seek(int(entry['offset']))
+                record = json.loads(readfile.readline())
+                if int(record['l_r']) != entry['l_r']:
+                    raise ValueError('the log of station ' + str(station) + ' was rewritten')
+                records.append(record)
+        return records
+
+    def get_partition(self, station, partition):
+        """Returns an array of the record times of one of a station's sealed
+        partitions and a list of its record lines, decompressing it only if
+        it isn't loaded already. A partition that rotation has extended
+        since it was loaded is loaded again."""
+        key = (partition['path'], partition['last'], partition['records'])
+        with self.lock:
+            if key in self.partitions:
+                self.partitions.move_to_end(key)
+                return self.partitions[key]
+        archive_dir = rotation.get_archive_dir(self.get_log_file(station))
+        lines = rotation.read_partition(archive_dir, partition)
+        times = np.array([rotation.get_record_time(line) for line in lines], dtype=np.int64)
+        with self.lock:
+            self.partitions[key] = (times, lines)
+            while len(self.partitions) > self.max_partitions:
+                self.partitions.popitem(last=False)
+        return times, lines
+
+    def read_indexed(self, station, lookup):
+        """Returns lookup(index) on a station's index, trying once more on
+        a fresh index if the log was rewritten while it was being read"""
+        try:
+            return lookup(self.get_index(station))
+        except ValueError:
+            return lookup(self.get_index(station))
+
+    def read_sealed_records(self, station, t0, t1):
+        """Returns the records a station reported from t0 to t1 inclusive
+        that have been sealed into the archive and aren't in its index"""
+        index = self.get_index(station)
+        if len(index):
+            t1 = min(t1, int(index['l_r'][0]) - 1)
+        if t1 < t0:
+            return []
+        records = []
+        for partition in rotation.get_partitions(self.get_log_file(station), t0, t1):
+            times, lines = self.get_partition(station, partition)
+            first = np.searchsorted(times, t0, side='left')
+            last = np.searchsorted(times, t1, side='right')
+            records.extend(json.loads(line) for line in lines[first:last])
+        return records
+
+    def sealed_state_at(self, station, t):
+        """Returns the last record a station reported by time t out of its
+        sealed partitions, or None"""
+        # the state at t is in the last partition that starts by t
+        for partition in rotation.get_partitions(self.get_log_file(station), t, t):
+            times, lines = self.get_partition(station, partition)
+            position = np.searchsorted(times, t, side='right') - 1
+            if position >= 0:
+                return json.loads(lines[position])
+        return None
+
+    def state_at(self, station, t):
+        """Returns the record a station had last reported as of time t, or
+        None if it hadn't reported yet"""
+
+        def lookup(index):
+            position = np.searchsorted(index['l_r'], t, side='right') - 1
+            if position < 0:
+                return self.sealed_state_at(station, t)
+            return self.read_records(station, index[position:position + 1])[0]
+
+        return self.read_indexed(station, lookup)
+
+    def range(self, station, t0, t1):
+        """Returns every record a station reported from t0 to t1 inclusive"""
+
+        def lookup(index):
+            first = np.searchsorted(index['l_r'], t0, side='left')
+            last = np.searchsorted(index['l_r'], t1, side='right')
+            return (self.read_sealed_records(station, t0, t1) +
+                    self.read_records(station, index[first:last]))
+
+        return self.read_indexed(station, lookup)
+
+    def heartbeats(self, station, t0, t1):
+        """Returns the last_reported times from t0 to t1 inclusive of the
+        reports a station made without changing, which weren't logged"""
+        heartbeat_file = os.path.join(self.data_dir, str(station) + '.hb')
+        return [t for t in map(int, rotation.iter_lines(heartbeat_file, t0, t1)) if t0 <= t <= t1]
+
+    def snapshot(self, t):
+        """Returns a dict of station_id -> the state of every station as of
+        time t, leaving out stations that hadn't reported yet"""
+        states = {}
+        for station in self.get_stations():
+            state = self.state_at(station, t)
+            if state is not None:
+                states[station] = state
+        return states
+
+
+def make_handler(history):
+    """Returns a request handler class that answers queries from history"""
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        """Serves /state, /range, /snapshot and /heartbeats as JSON"""
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            try:
+                if url.path == '/state':
+                    result = history.state_at(query['station'], int(query['t']))
+                elif url.path == '/range':
+                    result = history.range(query['station'], int(query['t0']), int(query['t1']))
+                elif url.path == '/snapshot':
+                    result = history.snapshot(int(query['t']))
+                elif url.path == '/heartbeats':
+                    result = history.heartbeats(query['station'], int(query['t0']),
+                                                int(query['t1']))
+                else:
+                    self.send_error(404)
+                    return
+            except (KeyError, ValueError) as error:
+                self.send_error(400, str(error))
+                return
+            body = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return QueryHandler
+
+
+def serve(port=8080, data_dir='data/'):
+    """Serves queries on localhost until interrupted"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(History(data_dir)))
+    print("Serving queries on http://127.0.0.1:" + str(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
@@ -0,0 +1,303 @@
+"""Day-partitioned rotation of the logs.
+
+The station logs and last_updated.txt stay small by sealing every record
+from before the current (UTC) day into a gzip-compressed partition per
+log per day, next to the log in an archive directory:
+    data/65.txt.............Active log, only what was logged since the cutoff
+    data/archive/2016-10-03/65.txt.gz
+    data/archive/manifest.json
+The heartbeat logs hub_where.py can keep (data/<station_id>.hb) are
+sealed the same way. A sealed partition holds its records in the same
+layout as the active log.
+The manifest lists the partitions of every log in time order along with
+the first and last record time in each, so readers only decompress the
+partitions that overlap the interval they ask for. It also counts how many
+bytes have been cut off the front of every active log, so that byte
+offsets into a log taken before a rotation can be carried over.
+
+Partitions are written first, then the manifest, then the active logs,
+each on disk before the next is written, so that a crash at any point
+loses nothing: records still in an active log that the manifest says are
+sealed are dropped by the next rotation and skipped by the readers.
+
+The .dlt logs of the delta encoding aren't rotated: every record in one
+is encoded against the record before it, so they can't be cut at a day
+boundary without being rewritten, and they grow by only a few bytes per
+change. They keep everything ever logged.
+
+Rotation rewrites the active logs, so nothing may have them open for
+appending while it runs. hub_where.py rotates when the feed's day changes,
+after closing its file handles.
+
+Usage:
+    python rotation.py
+seals everything logged before today in data/ and last_updated.txt. Only
+run it while the collector is stopped."""
+
+import os
+import re
+import sys
+import json
+import gzip
+import time
+from bisect import bisect_right
+import storage
+
+ARCHIVE_DIR = 'archive'
+MANIFEST_FILE = 'manifest.json'
+DAY = 86400
+# last_reported in a record as hub_where.py writes it, which is far cheaper
+# to find than parsing the whole record
+LAST_REPORTED_PATTERN = re.compile(r'"l_r": "?(\d+)')
+
+# manifests already loaded by this process, by archive directory, along
+# with the modification time they were loaded at
+loaded_manifests = {}
+
+
+def get_archive_dir(file_name):
+    """Returns the archive directory that holds a log's partitions"""
+    return os.path.join(os.path.dirname(file_name), ARCHIVE_DIR)
+
+
+def load_manifest(archive_dir, cached=True):
+    """Loads the manifest of an archive directory, or returns an empty one.
+
+    Unless cached is False, a manifest that hasn't changed since this
+    process last loaded it is shared rather than parsed again, so it must
+    not be modified."""
+    manifest_file = os.path.join(archive_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_file):
+        return {}
+    mtime = os.stat(manifest_file).st_mtime_ns
+    if cached and loaded_manifests.get(archive_dir, (None,))[0] == mtime:
+        return loaded_manifests[archive_dir][1]
+    with open(manifest_file, 'r') as readfile:
+        manifest = json.load(readfile)
+    if cached:
+        loaded_manifests[archive_dir] = (mtime, manifest)
+    return manifest
+
+
+def save_manifest(manifest, archive_dir):
+    """Saves the manifest"""
+    with storage.replace_file(os.path.join(archive_dir, MANIFEST_FILE), 'w') as workfile:
+        json.dump(manifest, workfile)
+
+
+def get_log_entry(manifest, file_name):
+    """Returns the manifest entry of a log, which holds its partitions and
+    how many bytes have been rotated out of it"""
+    return manifest.get(os.path.basename(file_name), {'rotated_bytes': 0, 'partitions': []})
+
+
+def get_sealed_until(entry):
+    """Returns the time of the last sealed record of a log, or -1"""
+    return entry['partitions'][-1]['last'] if entry['partitions'] else -1
+
+
+def get_record_time(line):
+    """Returns the time of a record: the timestamp itself for
+    last_updated.txt and the heartbeat logs, or last_reported for a
+    station log"""
+    line = line.strip()
+    if line.isdigit():
+        return int(line)
+    # a torn record can't end in a brace, since records hold no objects
+    match = LAST_REPORTED_PATTERN.search(line) if line.endswith('}') else None
+    if match:
+        return int(match.group(1))
+    return int(json.loads(line)['l_r'])
+
+
+def split_records(data):
+    """Returns (end, line) for every record of a log's bytes, where end is
+    the offset just past the record"""
+    records = []
+    position = 0
+    for line in data.split(b'\n'):
+        position += len(line) + 1
+        if line.strip():
+            records.append((min(position - 1, len(data)), line.decode('utf-8')))
+    return records
+
+
+def get_day_name(t):
+    """Returns the UTC day a time falls on, as YYYY-MM-DD"""
+    return time.strftime('%Y-%m-%d', time.gmtime(t))
+
+
+def read_partition(archive_dir, partition):
+    """Returns the record lines of a sealed partition. Anything past the
+    partition's last time was left behind by an interrupted rotation."""
+    with gzip.open(os.path.join(archive_dir, partition['path']), 'rb') as readfile:
+        data = readfile.read()
+    return [line for end, line in split_records(data) if get_record_time(line) <= partition['last']]
+
+
+def write_partition(archive_dir, path, lines):
+    """Writes the record lines of a partition"""
+    partition_file = os.path.join(archive_dir, path)
+    if not os.path.isdir(os.path.dirname(partition_file)):
+        os.makedirs(os.path.dirname(partition_file))
+        storage.sync_directory(archive_dir)
+    with storage.replace_file(partition_file, opener=gzip.open) as workfile:
+        workfile.write(''.join('\n' + line for line in lines).encode('utf-8'))
+
+
+def seal_records(entry, archive_dir, log_name, lines):
+    """Adds record lines from before the cutoff to the day partitions of a
+    log, extending the last partition if it's for the same day"""
+    days = {}
+    for line in lines:
+        days.setdefault(get_day_name(get_record_time(line)), []).append(line)
+    for day_name in sorted(days):
+        day_lines = days[day_name]
+        path = os.path.join(day_name, log_name + '.gz')
+        partitions = entry['partitions']
+        if partitions and partitions[-1]['path'] == path:
+            partition = partitions[-1]
+            day_lines = read_partition(archive_dir, partition) + day_lines
+        else:
+            partition = {'path': path, 'first': get_record_time(day_lines[0])}
+            partitions.append(partition)
+        write_partition(archive_dir, path, day_lines)
+        partition['last'] = get_record_time(day_lines[-1])
+        partition['records'] = len(day_lines)
+
+
+def rotate_logs(file_names, cutoff):
+    """Seals every record from before cutoff in the given logs. Returns the
+    logs that were rewritten."""
+    by_archive = {}
+    for file_name in file_names:
+        by_archive.setdefault(get_archive_dir(file_name), []).append(file_name)
+    rotated = []
+    for archive_dir, archive_files in by_archive.items():
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+            storage.sync_directory(os.path.dirname(archive_dir))
+        manifest = load_manifest(archive_dir, cached=False)
+        cuts = []
+        for file_name in archive_files:
+            with open(file_name, 'rb') as readfile:
+                data = readfile.read()
+            log_name = os.path.basename(file_name)
+            entry = manifest.setdefault(log_name, {'rotated_bytes': 0, 'partitions': []})
+            sealed_until = get_sealed_until(entry)
+            cut = 0
+            already_sealed = 0
+            lines = []
+            for end, line in split_records(data):
+                try:
+                    record_time = get_record_time(line)
+                except ValueError:
+                    # a torn record, left for writer.recover_logs()
+                    break
+                if record_time >= cutoff:
+                    break
+                cut = end
+                if record_time <= sealed_until:
+                    already_sealed = end
+                else:
+                    lines.append(line)
+            if not cut:
+                continue
+            if lines:
+                seal_records(entry, archive_dir, log_name, lines)
+            # bytes still in the log that an interrupted rotation had already
+            # counted as rotated out aren't counted again
+            entry['rotated_bytes'] += cut - already_sealed
+            cuts.append((file_name, data[cut:]))
+        if not cuts:
+            continue
+        save_manifest(manifest, archive_dir)
+        for file_name, remaining in cuts:
+            with storage.replace_file(file_name) as workfile:
+                workfile.write(remaining)
+            rotated.append(file_name)
+    return rotated
+
+
+def rotate(data_dir='data/', last_updated_file='last_updated.txt', cutoff=None):
+    """Seals everything in last_updated.txt, the station logs and their
+    heartbeat logs from before cutoff, by default the start of the current
+    UTC day. Returns the logs that were rewritten."""
+    if cutoff is None:
+        cutoff = int(time.time()) // DAY * DAY
+    file_names = [os.path.join(data_dir, x) for x in os.listdir(data_dir)
+                  if (x[:-4].isdigit() and x.endswith('.txt'))
+                  or (x[:-3].isdigit() and x.endswith('.hb'))]
+    if os.path.exists(last_updated_file):
+        file_names.append(last_updated_file)
+    return rotate_logs(file_names, cutoff)
+
+
+def get_partitions(file_name, t0=None, t1=None, manifest=None):
+    """Returns the partitions of a log that overlap t0..t1, along with the
+    one holding the state of the log at t0"""
+    if manifest is None:
+        manifest = load_manifest(get_archive_dir(file_name))
+    partitions = get_log_entry(manifest, file_name)['partitions']
+    firsts = [partition['first'] for partition in partitions]
+    start = 0 if t0 is None else max(bisect_right(firsts, t0) - 1, 0)
+    stop = len(partitions) if t1 is None else bisect_right(firsts, t1)
+    return partitions[start:stop]
+
+
+def read_active_lines(file_name, sealed_until=-1):
+    """Returns the record lines of an active log, leaving out any that were
+    already sealed"""
+    if not os.path.exists(file_name):
+        return []
+    with open(file_name, 'rb') as readfile:
+        data = readfile.read()
+    lines = []
+    for end, line in split_records(data):
+        try:
+            record_time = get_record_time(line)
+        except ValueError:
+            break
+        if record_time > sealed_until:
+            lines.append(line)
+    return lines
+
+
+def iter_lines(file_name, t0=None, t1=None, active=True):
+    """Yields the record lines of a log, from the sealed partitions that
+    overlap t0..t1 (and the one holding the state at t0), followed by the
+    whole active log unless active is False. Records outside t0..t1 that
+    share a partition with ones inside are yielded too."""
+    archive_dir = get_archive_dir(file_name)
+    manifest = load_manifest(archive_dir)
+    for partition in get_partitions(file_name, t0, t1, manifest):
+        for line in read_partition(archive_dir, partition):
+            yield line
+    if active:
+        sealed_until = get_sealed_until(get_log_entry(manifest, file_name))
+        for line in read_active_lines(file_name, sealed_until):
+            yield line
+
+
+def get_rotated_bytes(file_name):
+    """Returns how many bytes have been cut off the front of a log by
+    rotation, to turn offsets taken before a rotation into current ones"""
+    return get_log_entry(load_manifest(get_archive_dir(file_name)), file_name)['rotated_bytes']
+
+
+def get_bounds(file_name):
+    """Returns the times of the first and last record of a log, sealed or
+    not, or None if it has no records"""
+    entry = get_log_entry(load_manifest(get_archive_dir(file_name)), file_name)
+    lines = read_active_lines(file_name, get_sealed_until(entry))
+    times = [get_record_time(line) for line in lines[:1] + lines[-1:]]
+    if entry['partitions']:
+        times = [entry['partitions'][0]['first'], entry['partitions'][-1]['last']] + times
+    if not times:
+        return None
+    return (times[0], times[-1])
+
+
+if __name__ == "__main__":
+    for file_name in rotate(*sys.argv[1:3]):
+        print("Rotated", file_name)
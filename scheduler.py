@@ -0,0 +1,79 @@
+"""Scheduler that decides when hub_where.py polls the Hubway feed next.
+
+GBFS feeds say when they were generated (last_updated) and for how many
+seconds that data stays current (ttl). PollScheduler sleeps until just
+after the feed is due to refresh, instead of spinning on the clock, and
+keeps count of ticks that came late or were missed entirely."""
+
+import time
+
+
+class PollScheduler:
+    """Sleeps until the next poll and reports late or missed ticks.
+
+    interval is how often to poll when the feed doesn't say, min_interval
+    is the shortest time allowed between two polls, slack is how long to
+    give the feed to refresh after its ttl runs out and tolerance is how
+    late a tick can be before it is reported."""
+
+    def __init__(self, interval=60, min_interval=5, slack=2, tolerance=5):
+        self.interval = interval
+        self.min_interval = min_interval
+        self.slack = slack
+        self.tolerance = tolerance
+        self.late = 0
+        self.missed = 0
+        self.stale_polls = 0
+        self.last_updated = None
+        self.next_tick = self.get_regular_tick(time.time())
+
+    def get_regular_tick(self, now):
+        """Returns the next whole multiple of interval after now"""
+        return (int(now // self.interval) + 1) * self.interval
+
+    def schedule(self, station_status=None):
+        """Schedules the next tick based on the feed that was just polled.
+
+        Without ttl and last_updated fields, polls on the next multiple of
+        interval. If the feed hasn't refreshed since the last poll, polls
+        again soon, backing off up to interval."""
+        now = time.time()
+        if station_status is None or 'ttl' not in station_status or 'last_updated' not in station_status:
+            self.next_tick = self.get_regular_tick(now)
+            return self.next_tick
+        last_updated = int(station_status['last_updated'])
+        if last_updated == self.last_updated:
+            self.stale_polls += 1
+        else:
+            self.stale_polls = 0
+        self.last_updated = last_updated
+        expected = last_updated + int(station_status['ttl']) + self.slack
+        if expected <= now:
+            # the feed should have refreshed by now but hasn't
+            backoff = self.min_interval * 2 ** self.stale_polls
+            self.next_tick = now + min(backoff, self.interval)
+        else:
+            self.next_tick = max(expected, now + self.min_interval)
+        return self.next_tick
+
+    def get_delay(self):
+        """Returns how many seconds are left until the next tick"""
+        return max(0, self.next_tick - time.time())
+
+    def check_tick(self):
+        """Reports the tick as late or missed if it is, and returns how late
+        it is. Call this right after waking up for a tick."""
+        lateness = time.time() - self.next_tick
+        if lateness > self.interval:
+            missed = int(lateness // self.interval)
+            self.missed += missed
+            print("Missed", missed, "ticks, total missed:", self.missed)
+        elif lateness > self.tolerance:
+            self.late += 1
+            print("Tick late by", int(lateness), "seconds, total late:", self.late)
+        return lateness
+
+    def wait(self):
+        """Sleeps until the next tick and returns how late it woke up"""
+        time.sleep(self.get_delay())
+        return self.check_tick()
@@ -0,0 +1,83 @@
+"""Helpers for files that are always rewritten whole.
+
+replace_file() writes a new version of a file next to it and swaps it in
+with os.replace(), so readers and crashes only ever see the old file or
+the new one, even after a power loss. It backs every manifest, cache,
+partition and saved feed.
+
+A station table is a dict of NumPy arrays with a 'station_ids' array and
+one row per station in every other array, saved as an .npz file. The
+aggregate cache in plots/ and the occupancy profiles are station tables."""
+
+import os
+from contextlib import contextmanager
+import numpy as np
+
+
+def sync_file(file_name):
+    """Makes sure a closed file's contents are on disk"""
+    descriptor = os.open(file_name, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def sync_directory(directory):
+    """Makes sure the entries of a directory, such as a file just renamed
+    into it, are on disk. Directories can't be opened on Windows, where
+    renames are durable without this."""
+    if os.name != 'nt':
+        sync_file(directory or '.')
+
+
+@contextmanager
+def replace_file(file_name, mode='wb', opener=open):
+    """Opens a temporary file to write a new version of file_name in, which
+    replaces it atomically at the end of the with block. The new version
+    is on disk before it replaces the old one, and the rename is on disk
+    before this returns, so the files written through here reach the disk
+    in the order they were written. If the block fails, the temporary file
+    is removed and file_name is left as it was."""
+    temp_name = file_name + '.tmp'
+    try:
+        with opener(temp_name, mode) as workfile:
+            yield workfile
+        sync_file(temp_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+    os.replace(temp_name, file_name)
+    sync_directory(os.path.dirname(file_name))
+
+def load_table(file_name, make_table):
+    """Loads a station table from file_name, or returns make_table() if
+    there isn't one"""
+    if not os.path.exists(file_name):
+        return make_table()
+    with np.load(file_name) as table_file:
+        return {name: table_file[name] for name in table_file.files}
+
+
+def save_table(table, file_name, compressed=False):
+    """Saves a station table, replacing the old file atomically"""
+    with replace_file(file_name) as workfile:
+        if compressed:
+            np.savez_compressed(workfile, **table)
+        else:
+            np.savez(workfile, **table)
+
+
+def get_station_row(table, station_id, defaults):
+    """Returns the row of station_id in a station table. A station the table
+    hasn't seen before gets a new row, filled with the value defaults gives
+    for each array."""
+    rows = np.flatnonzero(table['station_ids'] == int(station_id))
+    if len(rows):
+        return rows[0]
+    table['station_ids'] = np.append(table['station_ids'], int(station_id))
+    for name, default in defaults.items():
+        row = np.full((1,) + table[name].shape[1:], default, dtype=table[name].dtype)
+        table[name] = np.concatenate((table[name], row))
+    return len(table['station_ids']) - 1
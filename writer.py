@@ -0,0 +1,183 @@
+"""Buffered writer for the Hubway station logs.
+
+Instead of opening, appending to and closing a log file for every record,
+LogWriter buffers records in memory, writes them out in batches and keeps
+the file handles open between batches. The number of open handles is
+bounded by an LRU so that hundreds of stations don't exhaust the process's
+file descriptors. By default the bound is half the process's descriptor
+limit, so that every station log and heartbeat log of a system the size
+of Hubway's stays open: a flush visits the logs in the same order every
+time, which an LRU too small to hold them all turns into an open and a
+close per record."""
+
+import os
+import json
+import time
+from collections import OrderedDict
+import delta_codec
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+DEFAULT_MAX_HANDLES = 256
+
+
+def get_default_max_handles():
+    """Returns half the soft limit on open file descriptors, leaving the
+    rest for sockets and everything else, or DEFAULT_MAX_HANDLES where the
+    limit can't be read"""
+    if resource is None:
+        return DEFAULT_MAX_HANDLES
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    if soft_limit == resource.RLIM_INFINITY:
+        return DEFAULT_MAX_HANDLES * 16
+    return max(soft_limit // 2, 16)
+
+
+class LogWriter:
+    """Batches appends to the log files and fsyncs them on a schedule.
+
+    Every record is written as a newline followed by the record, the same
+    layout the logs have always had, unless it is binary and queued with
+    write_bytes(). Records are only written out when
+    tick(), flush() or close() is called, and each file's pending records
+    go out in one write() so that a crash can tear at most the last one.
+    Handles evicted from the LRU are closed without an fsync, and the files
+    are fsynced along with the open ones on the next scheduled fsync."""
+
+    def __init__(self, max_handles=None, flush_interval=60, fsync_interval=600):
+        self.max_handles = get_default_max_handles() if max_handles is None else max_handles
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.handles = OrderedDict()
+        # files written to and closed since the last fsync
+        self.unsynced = set()
+        self.pending = {}
+        self.last_flush = time.time()
+        self.last_fsync = time.time()
+        self.bytes_written = 0
+
+    def write(self, file_name, line):
+        """Queues one record to be appended to file_name"""
+        self.pending.setdefault(file_name, []).append(('\n' + line).encode('utf-8'))
+
+    def write_bytes(self, file_name, data):
+        """Queues one binary record to be appended to file_name as is"""
+        self.pending.setdefault(file_name, []).append(data)
+
+    def tick(self):
+        """Flushes and fsyncs if their intervals have passed. Meant to be
+        called once per poll. Returns the files that were written to."""
+        now = time.time()
+        flushed = []
+        if now - self.last_flush >= self.flush_interval:
+            flushed = self.flush()
+        if now - self.last_fsync >= self.fsync_interval:
+            self.fsync()
+        return flushed
+
+    def flush(self):
+        """Writes every pending record out to its file. Returns the files
+        that were written to."""
+        pending, self.pending = self.pending, {}
+        for file_name, lines in pending.items():
+            handle = self.get_handle(file_name)
+            data = b''.join(lines)
+            handle.write(data)
+            handle.flush()
+            self.bytes_written += len(data)
+        self.last_flush = time.time()
+        return list(pending)
+
+    def fsync(self):
+        """Makes sure everything written so far is on disk"""
+        for handle in self.handles.values():
+            os.fsync(handle.fileno())
+        for file_name in self.unsynced - set(self.handles):
+            try:
+                descriptor = os.open(file_name, os.O_RDONLY)
+            except FileNotFoundError:
+                # removed since it was closed
+                continue
+            try:
+                os.fsync(descriptor)
+            finally:
+                os.close(descriptor)
+        self.unsynced.clear()
+        self.last_fsync = time.time()
+
+    def close(self):
+        """Flushes, fsyncs and closes every file. Call this at shutdown."""
+        self.flush()
+        self.fsync()
+        while self.handles:
+            self.handles.popitem()[1].close()
+
+    def get_handle(self, file_name):
+        """Returns an open handle for file_name, evicting the least recently
+        used handle if there are too many open"""
+        if file_name in self.handles:
+            self.handles.move_to_end(file_name)
+            return self.handles[file_name]
+        while len(self.handles) >= self.max_handles:
+            evicted_name, evicted = self.handles.popitem(last=False)
+            evicted.close()
+            self.unsynced.add(evicted_name)
+        self.handles[file_name] = open(file_name, 'ab')
+        return self.handles[file_name]
+
+
+def is_json_line(line):
+    """Returns True if the line is a complete JSON record"""
+    try:
+        json.loads(line)
+    except ValueError:
+        return False
+    return True
+
+
+def is_int_line(line):
+    """Returns True if the line is a complete epoch timestamp"""
+    return line.strip().isdigit() and len(line.strip()) >= 10
+
+
+def recover_file(file_name, is_valid=is_json_line):
+    """Truncates a torn trailing record left behind by a crash.
+
+    Trailing newlines are trimmed as well, since the next record brings its
+    own. Returns True if a torn record had to be dropped."""
+    with open(file_name, 'rb+') as workfile:
+        size = workfile.seek(0, 2)
+        workfile.seek(max(0, size - 65536))
+        tail = workfile.read()
+        end = len(tail.rstrip(b'\n'))
+        line_start = tail.rfind(b'\n', 0, end)
+        torn = end > 0 and not is_valid(tail[line_start + 1:end].decode('utf-8', 'replace'))
+        if torn:
+            # drop the torn record along with the newline in front of it
+            end = max(line_start, 0)
+        if end < len(tail):
+            workfile.truncate(size - len(tail) + end)
+    return torn
+
+
+def recover_logs(data_dir='data/', last_updated_file='last_updated.txt'):
+    """Recovers every station log and last_updated.txt after a crash.
+
+    Returns the list of files that had a torn record dropped."""
+    recovered = []
+    if os.path.exists(last_updated_file) and recover_file(last_updated_file, is_int_line):
+        recovered.append(last_updated_file)
+    for file_name in os.listdir(data_dir):
+        if file_name[:-4].isdigit() and file_name.endswith('.txt'):
+            if recover_file(os.path.join(data_dir, file_name)):
+                recovered.append(os.path.join(data_dir, file_name))
+        elif file_name[:-4].isdigit() and file_name.endswith('.dlt'):
+            if delta_codec.recover_file(os.path.join(data_dir, file_name)):
+                recovered.append(os.path.join(data_dir, file_name))
+        elif file_name[:-3].isdigit() and file_name.endswith('.hb'):
+            if recover_file(os.path.join(data_dir, file_name), is_int_line):
+                recovered.append(os.path.join(data_dir, file_name))
+    return recovered